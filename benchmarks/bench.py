@@ -0,0 +1,322 @@
+"""
+bench.py
+
+Description:
+    Benchmarks of the hot paths of patlang String, List and Tree, for a
+    range of sizes. Results can be written as JSON and compared against a
+    saved baseline to catch regressions.
+
+Usage:
+    python benchmarks/bench.py
+    python benchmarks/bench.py --sizes 100,1000 --json baseline.json
+    python benchmarks/bench.py --compare baseline.json --threshold 0.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from patlang import String, List, Tree
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Benchmarks                                                                   #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+# name: setup(size, depth, fanout) -> function to time, registered in order
+BENCHMARKS = dict()
+
+def benchmark(name):
+    """
+    register the decorated setup function as benchmark name
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def template(size):
+    """
+    returns a String of size fragments with a variable between every two
+    """
+    S = String("".join("text%d <v%d> " % (i, i % (size // 2 + 1))
+                       for i in range(size)))
+    for i in range(size // 2 + 1):
+        S.variables["<v%d>" % i] = "value%d" % i
+    return S
+
+def nested(size, depth, fanout):
+    """
+    returns a List with size variables v0 .. v<size-1> spread over Lists
+    nested depth deep, with at most fanout items per List
+    """
+    names = iter(range(size))
+    def build(count, level):
+        if level >= depth or count <= fanout:
+            return List(*[List.Variable("v%d" % next(names), "x")
+                          for _ in range(count)])
+        share = -(-count // fanout)
+        return List(*[build(min(share, count - i * share), level + 1)
+                      for i in range(fanout) if count - i * share > 0])
+    return build(size, 0)
+
+def paths(size, depth, fanout):
+    """
+    returns size paths of depth values, each value out of fanout
+    """
+    return [tuple("%d" % ((i // fanout ** level) % fanout)
+                  for level in range(depth - 1)) + ("leaf%d" % i,)
+            for i in range(size)]
+
+@benchmark("String.__str__")
+def _(size, depth, fanout):
+    S = template(size)
+    key = "<v0>"
+    def run():
+        # setting a variable invalidates the cached rendering
+        S[key] = "value0"
+        str(S)
+    return run
+
+@benchmark("String.__str__ cached")
+def _(size, depth, fanout):
+    S = template(size)
+    return lambda: str(S)
+
+@benchmark("String.flush")
+def _(size, depth, fanout):
+    text = "".join("<v%d> " % i for i in range(size))
+    variables = {"<v%d>" % i: "x <v%d>" % (i + 1) for i in range(size)}
+    variables["<v%d>" % size] = "end"
+    def run():
+        S = String(text)
+        S.variables = dict(variables)
+        S.flush()
+    return run
+
+@benchmark("String.toList")
+def _(size, depth, fanout):
+    S = template(size)
+    return lambda: S.toList(True, " ")
+
+@benchmark("List.getVariable")
+def _(size, depth, fanout):
+    L = nested(size, depth, fanout)
+    key = "v%d" % (size - 1)
+    return lambda: L.getVariable(key)
+
+@benchmark("List.setVariable")
+def _(size, depth, fanout):
+    L = nested(size, depth, fanout)
+    key = "v%d" % (size - 1)
+    return lambda: L.setVariable(key, "y")
+
+@benchmark("List.__str__")
+def _(size, depth, fanout):
+    L = nested(size, depth, fanout)
+    key = "v%d" % (size - 1)
+    def run():
+        L.setVariable(key, "y")
+        str(L)
+    return run
+
+@benchmark("List.copy")
+def _(size, depth, fanout):
+    L = nested(size, depth, fanout)
+    return L.copy
+
+@benchmark("Tree insert")
+def _(size, depth, fanout):
+    values = paths(size, depth, fanout)
+    def run():
+        T = Tree()
+        for path in values:
+            node = T
+            for value in path:
+                node = node[value]
+    return run
+
+@benchmark("Tree.from_paths")
+def _(size, depth, fanout):
+    values = paths(size, depth, fanout)
+    return lambda: Tree.from_paths(values)
+
+@benchmark("Tree.iter_paths")
+def _(size, depth, fanout):
+    T = Tree.from_paths(paths(size, depth, fanout))
+    return lambda: sum(1 for _ in T.iter_paths())
+
+@benchmark("Tree.__contains__")
+def _(size, depth, fanout):
+    T = Tree.from_paths(paths(size, depth, fanout))
+    key = "leaf%d" % (size - 1)
+    return lambda: key in T
+
+@benchmark("Tree insert then in")
+def _(size, depth, fanout):
+    values = paths(size, depth, fanout)
+    T = Tree.from_paths(values)
+    key = "leaf%d" % (size - 1)
+    count = iter(range(10**9))
+    def run():
+        # a new node between lookups, the lookup cannot use a stale index
+        T[values[0][0]]["new%d" % next(count)]
+        return key in T
+    return run
+
+@benchmark("Tree.getVariable changed")
+def _(size, depth, fanout):
+    T = Tree.from_paths([path + (Tree.Variable("var%d" % i),)
+                         for i, path in enumerate(paths(size, depth, fanout))])
+    values = [Tree.from_paths([("a", "b")]), Tree.from_paths([("c",)])]
+    key = "var%d" % (size - 1)
+    count = iter(range(10**9))
+    def run():
+        # a Tree value changes the nested Trees the lookup has to search
+        T.setVariable("var0", values[next(count) % 2])
+        return T.getVariable(key)
+    return run
+
+@benchmark("Tree.copy")
+def _(size, depth, fanout):
+    T = Tree.from_paths(paths(size, depth, fanout))
+    return T.copy
+
+@benchmark("Tree.__eq__")
+def _(size, depth, fanout):
+    values = paths(size, depth, fanout)
+    A = Tree.from_paths(values)
+    B = Tree.from_paths(values)
+    # equal hashes (cached after the first call), so the nodes are compared
+    return lambda: A == B
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Runner                                                                       #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+def measure(run, repeat, mintime):
+    """
+    returns the best time per call of run, over repeat rounds of as many
+    calls as fit in mintime
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(mintime / elapsed) + 1)
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def results(names, sizes, depth, fanout, repeat, mintime):
+    """
+    yield a result dict for each benchmark and size
+    """
+    for name in names:
+        for size in sizes:
+            run = BENCHMARKS[name](size, depth, fanout)
+            yield {"name": name, "size": size, "depth": depth,
+                   "fanout": fanout, "seconds": measure(run, repeat, mintime)}
+
+def compare(current, baseline, threshold):
+    """
+    print the ratio of each result to the baseline, returns the results
+    that are more than threshold slower
+    """
+    previous = {(r["name"], r["size"], r["depth"], r["fanout"]): r["seconds"]
+                for r in baseline["results"]}
+    regressions = []
+    for result in current:
+        key = (result["name"], result["size"], result["depth"],
+               result["fanout"])
+        if key not in previous:
+            continue
+        ratio = result["seconds"] / previous[key]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressions.append(result)
+        elif ratio < 1 / (1 + threshold):
+            mark = "  faster"
+        print("%-24s %8d %12s %12s %7.2fx%s" % (
+            result["name"], result["size"], duration(previous[key]),
+            duration(result["seconds"]), ratio, mark))
+    return regressions
+
+def duration(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.3f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("Usage:")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated sizes (default %(default)s)")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="depth of nested Lists and Tree paths")
+    parser.add_argument("--fanout", type=int, default=8,
+                        help="items per nested List, values per Tree level")
+    parser.add_argument("--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mintime", type=float, default=0.05,
+                        help="seconds per round (default %(default)s)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with the results of a previous --json")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown counted as regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = [name for name in BENCHMARKS if args.filter in name]
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    current = []
+    for result in results(names, sizes, args.depth, args.fanout,
+                          args.repeat, args.mintime):
+        current.append(result)
+        if baseline is None:
+            print("%-24s %8d %12s" % (result["name"], result["size"],
+                                      duration(result["seconds"])))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "results": current}, f, indent=1)
+
+    if baseline is not None:
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print("%d regression(s) over %d%%" % (len(regressions),
+                                                  args.threshold * 100))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -109,12 +109,27 @@ print(a)
 hello hallo hello
 """
 
-a.flush()
+try:
+    a.flush()
+except RecursionError as e:
+    print(e)
 
-print(repr(a))
-print(a)
+"""
+variables reference each other: 'hello' -> 'hallo' -> 'hello'
+"""
+
+b = String("V_File")
+b["V_File"] = "V_Header V_Body"
+b["V_Header"] = "// V_Name"
+b["V_Body"] = "class V_Name {};"
+b["V_Name"] = "SomeNewClass"
+
+b.flush()
+
+print(repr(b))
+print(b)
 
 """
-''hello':'hello 'hallo':'hallo hello hallo' hello''
-hello hallo hello hallo hello
+''V_File':'// SomeNewClass class SomeNewClass {};''
+// SomeNewClass class SomeNewClass {};
 """
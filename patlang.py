@@ -5,9 +5,13 @@ Author: Marijn van Tricht
 Date: 2025-04-17
 Description:
     Pattern language, contains:
-    String
+    String (& String.Builder)
     List (& List.Variable)
     Tree (& Tree.Variable)
+    render_batch
+    dump / load
+    TemplateCache
+    instrument
 """
 
 # Copyright 2025 Marijn van Tricht
@@ -24,12 +28,345 @@ Description:
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import collections.abc
+import concurrent.futures
+import hashlib
+import io
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+__all__ = ["String", "StringBuilder", "List", "VariableList", "CompiledList",
+           "Tree", "VariableTree", "render_batch", "dump", "load",
+           "TemplateCache", "instrument"]
+
 #------------------------------------------------------------------------------#
 #                                                                              #
 # String                                                                       #
 #                                                                              #
 #------------------------------------------------------------------------------#
 
+class _KeyStages():
+    """
+    which keys of a set of keys overlap, with the compiled regex of every
+    group of keys that was substituted in one stage
+
+    Values are left out and the order of the keys does not matter, so this is
+    only redone when the set of keys changes. tangles tells if a value could
+    interact with the keys, only then the values change the grouping.
+    """
+
+    def __init__(self, keys):
+        self.keyset = frozenset(keys)
+        self.patterns = dict()
+
+        # overlapping keys, found through the prefixes and the substrings
+        # (of key lengths) of every key instead of comparing every pair
+        self.overlaps = {key: set() for key in self.keyset}
+        prefixes = collections.defaultdict(set)
+        for key in self.keyset:
+            for i in range(1, len(key)):
+                prefixes[key[:i]].add(key)
+        lengths = set(map(len, self.keyset))
+        for key in self.keyset:
+            for i in range(1, len(key)):
+                for other in prefixes.get(key[-i:], ()):
+                    self._overlap(key, other)
+            for length in lengths:
+                for i in range(len(key) - length + 1 if length < len(key)
+                               else 0):
+                    if key[i:i + length] in self.keyset:
+                        self._overlap(key, key[i:i + length])
+
+        self.pattern = re.compile("|".join(map(re.escape, self.keyset)))
+        self.joined = "\0".join(self.keyset)
+        self.longest = max(lengths, default=0)
+        self.prefixes = set(prefixes)
+        self.suffixes = {key[-i:] for key in self.keyset
+                         for i in range(1, len(key))}
+
+    def _overlap(self, key, other):
+        if key != other:
+            self.overlaps[key].add(other)
+            self.overlaps[other].add(key)
+
+    def stages(self, keys):
+        """
+        yield (start, end, pattern) of the stages of keys (in this order),
+        pattern is None for a single key
+        """
+        start = 0
+        stage = set()
+        for end, key in enumerate(keys):
+            if stage and (key == "" or not self.overlaps[key].isdisjoint(stage)):
+                yield self._stage(keys, start, end)
+                start = end
+                stage = set()
+            stage.add(key)
+        if stage:
+            yield self._stage(keys, start, len(keys))
+
+    def _stage(self, keys, start, end):
+        if end - start == 1:
+            return start, end, None
+        # keys in a stage cannot overlap, so their order in the regex does
+        # not matter
+        stage = frozenset(keys[start:end])
+        pattern = self.patterns.get(stage)
+        if pattern is None:
+            pattern = self.patterns[stage] = re.compile(
+                "(" + "|".join(map(re.escape, stage)) + ")")
+        return start, end, pattern
+
+    def tangles(self, value):
+        """
+        True if value may overlap one of the keys (as _Substitution._overlaps)
+        """
+        if value == "" or self.pattern.search(value):
+            return True
+        if len(value) <= self.longest and value in self.joined:
+            return True
+        for i in range(1, min(len(value), self.longest)):
+            if value[:i] in self.suffixes or value[-i:] in self.prefixes:
+                return True
+        return False
+
+class _Substitution():
+    """
+    compiled substitution plan for an ordered list of (key, value) pairs
+
+    Applying the pairs one after the other with str.replace is the reference
+    behaviour (later keys also replace text produced by earlier values). Keys
+    that cannot interact are grouped into one stage, which is substituted in a
+    single regex pass, so independent keys cost one pass over the text.
+    """
+
+    def __init__(self, pairs, previous=None):
+        self.pairs = tuple(pairs)
+        keys = [key for key, _ in self.pairs]
+        values = [value for _, value in self.pairs]
+        self.stages = []
+
+        # the overlaps of the keys are kept from the previous plan, only the
+        # changed values are checked against the keys
+        if previous is not None and previous.keystages.keyset == set(keys):
+            self.keystages = previous.keystages
+            old = dict(previous.pairs)
+            self.tangled = {
+                key: (previous.tangled[key] if old[key] == value
+                      else self.keystages.tangles(value))
+                for key, value in self.pairs}
+        else:
+            self.keystages = _KeyStages(keys)
+            self.tangled = {key: self.keystages.tangles(value)
+                            for key, value in self.pairs}
+
+        if len(self.tangled) == len(keys) and not any(self.tangled.values()):
+            for start, end, pattern in self.keystages.stages(keys):
+                if pattern is None:
+                    self.stages.append((keys[start], values[start]))
+                else:
+                    self.stages.append((pattern, dict(
+                        zip(keys[start:end], values[start:end]))))
+            return
+
+        keys, values = [], []
+        for key, value in self.pairs:
+            if keys and not self._fits(key, keys, values):
+                self._addstage(keys, values)
+                keys, values = [], []
+            keys.append(key)
+            values.append(value)
+        if keys:
+            self._addstage(keys, values)
+
+    @staticmethod
+    def _overlaps(a, b):
+        """
+        True if a and b can share characters when both occur in a text
+        """
+        if a in b or b in a:
+            return True
+        for i in range(1, min(len(a), len(b))):
+            if a.endswith(b[:i]) or b.endswith(a[:i]):
+                return True
+        return False
+
+    def _fits(self, key, keys, values):
+        """
+        True if key can be substituted in the same pass as keys/values
+        """
+        if key == "":
+            return False
+        for otherKey, otherValue in zip(keys, values):
+            # the occurrences must be disjoint in the source text and the key
+            # may not match (partly) in a value substituted before it
+            if self._overlaps(key, otherKey) or self._overlaps(key, otherValue):
+                return False
+        return True
+
+    def _addstage(self, keys, values):
+        if len(keys) == 1:
+            self.stages.append((keys[0], values[0]))
+        else:
+            lookup = dict(zip(keys, values))
+            pattern = re.compile("(" + "|".join(map(re.escape, keys)) + ")")
+            self.stages.append((pattern, lookup))
+
+    def apply(self, text):
+        for target, replacement in self.stages:
+            if isinstance(target, str):
+                text = text.replace(target, replacement)
+            else:
+                parts = target.split(text)
+                parts[1::2] = [replacement[key] for key in parts[1::2]]
+                text = "".join(parts)
+        return text
+
+    def iter_chunks(self, text):
+        """
+        yield the substituted text in fragments, the text is only substituted
+        as a whole when it takes more than one stage
+        """
+        if len(self.stages) != 1:
+            yield self.apply(text)
+            return
+        target, replacement = self.stages[0]
+        if isinstance(target, str):
+            target, replacement = (re.compile(re.escape(target)),
+                                   {target: replacement})
+        pos = 0
+        for match in target.finditer(text):
+            if match.start() > pos:
+                yield text[pos:match.start()]
+            yield replacement[match.group()]
+            pos = match.end()
+        if pos < len(text):
+            yield text[pos:]
+
+class _Tokenizer():
+    """
+    splits a text on an ordered list of keys
+
+    Splitting on the keys one after the other is the reference behaviour (an
+    earlier key wins where keys overlap). Keys that cannot overlap are grouped
+    into one stage and found in a single regex scan.
+    """
+
+    def __init__(self, keys):
+        self.stages = []
+        stage = []
+        for key in keys:
+            if stage and (key == "" or any(_Substitution._overlaps(key, k)
+                                           for k in stage)):
+                self._addstage(stage)
+                stage = []
+            stage.append(key)
+        if stage:
+            self._addstage(stage)
+
+    def _addstage(self, keys):
+        if len(keys) == 1:
+            self.stages.append(keys[0])
+        else:
+            self.stages.append(
+                re.compile("(" + "|".join(map(re.escape, keys)) + ")"))
+
+    def tokens(self, text):
+        """
+        returns a list of (fragment, None) and ("", key) tokens
+        """
+        tokens = [(text, None)]
+        for stage in self.stages:
+            splitted = []
+            for fragment, key in tokens:
+                if key is not None:
+                    splitted.append((fragment, key))
+                elif isinstance(stage, str):
+                    if stage not in fragment:
+                        splitted.append((fragment, None))
+                        continue
+                    for idx, item in enumerate(fragment.split(stage)):
+                        if idx > 0:
+                            splitted.append(("", stage))
+                        splitted.append((item, None))
+                else:
+                    for idx, item in enumerate(stage.split(fragment)):
+                        splitted.append(("", item) if idx % 2 else (item, None))
+            tokens = splitted
+        return tokens
+
+class _Variables(dict):
+    """
+    variables of a patlang String, a dict with a version counter
+
+    Every mutation bumps the version, so a String (or any String sharing this
+    dict through __add__) knows when its rendered output is outdated.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self._static = None
+
+    def __reduce__(self):
+        # rebuilt through __init__, a copied dict starts at version 0
+        return (_Variables, (dict(self),))
+
+    def _bump(self):
+        self.version += 1
+        self._static = None
+
+    def static(self):
+        """
+        True if rendering only depends on the dict itself, which is the case
+        when all keys and values are plain (immutable) str
+        """
+        if self._static is None:
+            self._static = all(type(key) is str and type(value) is str
+                               for key, value in self.items())
+        return self._static
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._bump()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._bump()
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._bump()
+        return self
+
+    def pop(self, *args):
+        self._bump()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._bump()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._bump()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._bump()
+
+    def setdefault(self, key, default=None):
+        self._bump()
+        return super().setdefault(key, default)
+
 class String(str):
     """
     a patlang String
@@ -40,9 +377,39 @@ class String(str):
         new Pattern (String) with value, because string is immutable
         """ 
         pat = super().__new__(cls, value)
-        pat.variables = dict()
+        pat.variables = _Variables()
         return pat
 
+    @property
+    def variables(self):
+        return self.__dict__["_variables"]
+
+    @variables.setter
+    def variables(self, variables):
+        """
+        variables is kept as given, a plain dict stays shared with the caller
+        but only a versioned _Variables dict lets renders be cached
+        """
+        self.__dict__["_variables"] = variables
+
+    def _render(self, mode, render):
+        """
+        return cached render of mode ('str'/'repr'), or render and cache it
+        """
+        variables = self.variables
+        if not isinstance(variables, _Variables):
+            # a plain dict can change unnoticed
+            return render(variables)
+        cache = self.__dict__.setdefault("_rendered", dict())
+        cached = cache.get(mode)
+        if (cached is not None and cached[0] is variables
+            and cached[1] == variables.version):
+            return cached[2]
+        out = render(variables)
+        if variables.static():
+            cache[mode] = (variables, variables.version, out)
+        return out
+
     def __getitem__(self, key):
         return self.variables[key]
     
@@ -64,14 +431,53 @@ class String(str):
             return repr(self) == repr(other)
         return False
     
+    def _plan(self, mode, pairs):
+        """
+        returns the cached substitution plan of mode ('str'/'repr') for pairs
+        """
+        pairs = tuple(pairs)
+        plans = self.__dict__.setdefault("_plans", dict())
+        plan = plans.get(mode)
+        if plan is None or plan.pairs != pairs:
+            plan = _Substitution(pairs, plan)
+            plans[mode] = plan
+        return plan
+
+    def _substitute(self, text, mode, pairs):
+        """
+        substitute pairs in text with the cached plan of mode ('str'/'repr')
+        """
+        return self._plan(mode, pairs).apply(text)
+
     def __str__(self):
-        out = super().__str__()
-        variables = dict(self.variables)
-        
-        for key in variables:
-            out = out.replace(str(key), str(variables[key]))
-            
-        return out
+        return self._render("str", self._str)
+
+    def _str(self, variables):
+        return self._substitute(super().__str__(), "str",
+                                self._strpairs(variables))
+
+    def _strpairs(self, variables):
+        variables = dict(variables)
+        return ((str(key), str(variables[key])) for key in variables)
+
+    def iter_chunks(self):
+        """
+        yield the serialized string of self in fragments
+        """
+        cached = self.__dict__.get("_rendered", dict()).get("str")
+        if (cached is not None and cached[0] is self.variables
+            and cached[1] == self.variables.version):
+            yield cached[2]
+            return
+        plan = self._plan("str", self._strpairs(self.variables))
+        yield from plan.iter_chunks(super().__str__())
+
+    def render_to(self, fileobj):
+        """
+        write the serialized string of self to fileobj
+        """
+        for chunk in self.iter_chunks():
+            fileobj.write(chunk)
 
     def __contains__(self, key):
         if isinstance(key, str):
@@ -87,26 +493,107 @@ class String(str):
         return False
 
     def __repr__(self):
-        out = super().__repr__()
-        variables = dict(self.variables)
-        
-        for key in variables:
-            out = out.replace(
-                str(key), repr(key) + ":" + repr(variables[key]))
-            
-        return out
+        return self._render("repr", self._repr)
+
+    def _repr(self, variables):
+        variables = dict(variables)
+        pairs = ((str(key), repr(key) + ":" + repr(variables[key]))
+                 for key in variables)
+        return self._substitute(super().__repr__(), "repr", pairs)
+
+    def _references(self):
+        """
+        returns {key: [referenced keys]} for all values that contain other
+        keys, the referenced keys are in the order of self.variables
+        """
+        keys = [(key, str(key)) for key in self.variables]
+        graph = dict()
+        for key, value in self.variables.items():
+            if isinstance(value, str):
+                graph[key] = [otherKey for otherKey, name in keys
+                              if otherKey != key
+                              and str.__contains__(value, name)]
+        return graph
 
     def flush(self):
-        variables = dict(self.variables)
-        
-        for key in variables:
-            for otherKey in variables:
-                if key != otherKey:
-                    variables[otherKey] = variables[otherKey].replace(
-                        str(key), str(self.variables[key]))
-                    
+        """
+        replace the keys inside the values of the variables by their (fully
+        resolved) values, raises a RecursionError if variables reference each
+        other in a cycle
+        """
+        graph = self._references()
+
+        # depth first post-order, so every value is resolved after the values
+        # it references (0 = new, 1 = on the stack, 2 = resolved)
+        order = []
+        state = dict.fromkeys(graph, 0)
+        for root in graph:
+            if state[root]:
+                continue
+            state[root] = 1
+            stack = [(root, iter(graph[root]))]
+            while stack:
+                key, refs = stack[-1]
+                for ref in refs:
+                    if state.get(ref) == 1:
+                        cycle = [k for k, _ in stack]
+                        cycle = cycle[cycle.index(ref):] + [ref]
+                        raise RecursionError(
+                            "variables reference each other: "
+                            + " -> ".join(map(repr, cycle)))
+                    if state.get(ref) == 0:
+                        state[ref] = 1
+                        stack.append((ref, iter(graph[ref])))
+                        break
+                else:
+                    state[key] = 2
+                    order.append(key)
+                    stack.pop()
+
+        variables = _Variables(self.variables)
+        for key in order:
+            value = variables[key]
+            for ref in graph[key]:
+                value = str.replace(value, str(ref), str(variables[ref]))
+            variables[key] = value
+
         self.variables = variables
 
+    def stats(self):
+        """
+        returns a summary of self: the fragments and variables in the text
+        (nodes), the longest chain of variables referring to variables
+        (depth), the number of variables and the bytes of literal text
+        """
+        tokens = _Tokenizer(dict.fromkeys(self.variables)).tokens(
+            super().__str__())
+        graph = self._references()
+        depths = dict()
+        for root in graph:
+            if root in depths:
+                continue
+            # post-order, a variable in a cycle counts the ones after it
+            depths[root] = 0
+            stack = [(root, iter(graph[root]))]
+            while stack:
+                key, refs = stack[-1]
+                for ref in refs:
+                    if ref not in depths:
+                        depths[ref] = 0
+                        stack.append((ref, iter(graph[ref])))
+                        break
+                else:
+                    stack.pop()
+                    depths[key] = 1 + max((depths[ref] for ref in graph[key]),
+                                          default=0)
+        return {"nodes": sum(1 for fragment, key in tokens
+                             if fragment or key is not None),
+                "depth": max((depths.get(key, 1) for key in self.variables),
+                             default=0),
+                "variables": len(self.variables),
+                "bytes": sum(len(fragment.encode("utf-8", "surrogatepass"))
+                             for fragment, key in tokens)}
+
     # for compatiblity accross other patlang types
     def setItem(self, key, value):
         """
@@ -147,56 +634,128 @@ class String(str):
         """
         convert to patlang List
         """ 
-        S = super().__str__()
-        L = [List(S)]
-
-        dictovaries = dict(self.variables)
-
-        if sep != "": dictovaries.update({sep:""});
-        if endline != "": dictovaries.update({endline:""});
-        
-        for key in dictovaries:
-            Lint = [List()]
-            for l in L:
-                for item in l:
-                    if not isinstance(item, List.Variable):
-                        if key in item:
-                            items = item.split(key)
-                            for idx, item in enumerate(items):
-                                if idx > 0:
-                                    if key in self.variables:
-                                        Lint[-1].append(List.Variable(key, self.variables[key]))
-                                        nk = self.variables[key]
-                                        while nk in self.variables:
-                                            Lint[-1].setVariable(key, List.Variable(nk, self.variables[nk]))
-                                            nk = self.variables[nk]
-                                    elif key == endline:
-                                        Lint.append(List())
-                                if item != '':
-                                    Lint[-1].append(item)
-                        else:
-                            Lint[-1].append(item)
-                    else:
-                        Lint[-1].append(item)
+        keys = dict.fromkeys(self.variables)
+        if sep != "": keys.update({sep:None});
+        if endline != "": keys.update({endline:None});
 
-            if len(Lint) > 1:
-                L = []
-                for l in Lint:
-                    L.append(l.copy())
-            else:
-                L = [Lint[-1].copy()]
+        L = [List()]
+        variables = dict()
+        tokens = _Tokenizer(keys).tokens(super().__str__())
+        for fragment, key in tokens:
+            if key is None:
+                # only fragments created by splitting are dropped when empty
+                if fragment != '' or len(tokens) == 1:
+                    L[-1].append(fragment)
+            elif key in self.variables:
+                if key not in variables:
+                    variables[key] = self._toVariable(key)
+                L[-1].append(variables[key].copy())
+            elif key == endline:
+                L.append(List())
 
         if len(L) > 1:
             return L
         else:
             return L[0]
 
+    def _toVariable(self, key):
+        """
+        returns key as List.Variable, values that are keys themselves are
+        chained into (nested) variables
+        """
+        L = List(List.Variable(key, self.variables[key]))
+        nk = self.variables[key]
+        while nk in self.variables:
+            L.setVariable(key, List.Variable(nk, self.variables[nk]))
+            nk = self.variables[nk]
+        return list.__getitem__(L, 0)
+
     def toTree(self, flattend=True):
         """
-        convert to patlang Tree
-        """ 
-        L = self.toList(flattend)
-        return L.toTree(flattend)
+        convert to patlang Tree, as one path of the fragments and variables
+        """
+        tokens = _Tokenizer(dict.fromkeys(self.variables)).tokens(
+            super().__str__())
+        variables = dict()
+        T = Tree()
+        node = T
+        for fragment, key in tokens:
+            if key is None:
+                if fragment != '' or len(tokens) == 1:
+                    node = node[fragment]
+                continue
+            if key not in variables:
+                variable = self._toVariable(key)
+                variables[key] = Tree.Variable(key, variable.toTree().value)
+            node = node[variables[key].copy()]
+        return T
+
+class StringBuilder():
+    """
+    builds a patlang String from fragments
+
+    Appending keeps the fragment and merges its variables as String.__add__
+    does, in amortized O(1) per fragment. The text is joined once, when the
+    String is built, and the appended Strings are left unchanged.
+    """
+
+    __slots__ = ("_fragments", "_length", "_variables")
+
+    def __init__(self, *fragments):
+        self._fragments = []
+        self._length = 0
+        self._variables = dict()
+        for fragment in fragments:
+            self.append(fragment)
+
+    def append(self, other):
+        """
+        append str or patlang String other, the variables of other are
+        merged into the variables appended before
+        """
+        if not isinstance(other, str):
+            raise TypeError('can only concatenate str (not "%s") to str'
+                            % type(other).__name__)
+        text = str.__str__(other)
+        self._fragments.append(text)
+        self._length += len(text)
+        if isinstance(other, String):
+            self._variables.update(other.variables)
+        return self
+
+    def extend(self, fragments):
+        """
+        append every fragment of fragments
+        """
+        for fragment in fragments:
+            self.append(fragment)
+        return self
+
+    def __iadd__(self, other):
+        return self.append(other)
+
+    def __len__(self):
+        return self._length
+
+    def build(self):
+        """
+        returns the appended fragments as one patlang String, with its own
+        copy of the merged variables
+        """
+        if len(self._fragments) > 1:
+            # joined once, later builds start from the joined text
+            self._fragments[:] = ["".join(self._fragments)]
+        pat = String(self._fragments[0] if self._fragments else "")
+        pat.variables = _Variables(self._variables)
+        return pat
+
+    def __str__(self):
+        return str(self.build())
+
+    def __repr__(self):
+        return repr(self.build())
+
+String.Builder = StringBuilder
 
 #------------------------------------------------------------------------------#
 #                                                                              #
@@ -204,121 +763,684 @@ class String(str):
 #                                                                              #
 #------------------------------------------------------------------------------#
 
-class List(list):
+_UNHASHABLE = object()
+
+def _hashkey(value):
     """
-    a patlang List
+    returns a hashable key for value, lists are keyed as tuples and other
+    unhashable values share the _UNHASHABLE key
     """
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        if isinstance(value, list):
+            return tuple(map(_hashkey, value))
+        return _UNHASHABLE
 
-    def __init__(self, *args):
-        """
-        Init a Pattern (list) with *args
-        """
-        self.variables = dict()
-        super().__init__(args)
-        
-    def __getitem__(self, key, flattend = True):
-        """
-        will return a nested (if flattend) variable (if key is variable) or item whose name is matching the key
-        """            
-        if isinstance(key, slice):
-            items = super().__getitem__(key)
-            newPat = List()
-            for item in items:
-                newPat.append(item)
-            return newPat
+# a nested List (name None) or Variable of items, as seen by _joinString
+_Group = collections.namedtuple("_Group", ("name", "items"))
 
-        if isinstance(key, List.Variable):
-            return self.getVariable(key.name, flattend)
+def _joinString(root, expand, sep="", endline=""):
+    """
+    returns a patlang String of the items of root (a _Group) joined as in
+    List.toString, expand(item) returns the _Group of a nested item or
+    None for an item that is written as it is
+
+    Every item is visited once, nested Lists write into the parts of the
+    List they are in and a Variable joins its own parts when it ends, all
+    variables share one dict. The name of a Variable is written before its
+    items, so a nested Variable with the same name takes precedence, as with
+    merging a dict per level.
+    """
+    variables = dict()
+    written = dict()
+    writes = 0
+    stack = [(enumerate(root.items), len(root.items) - 1, [], None, 0)]
+    while True:
+        items, last, parts, name, mark = stack[-1]
+        for i, item in items:
+            if type(item) is str:
+                group = None
+            elif type(item) is _Group:
+                group = item
+            else:
+                group = expand(item)
+            if group is None:
+                parts.append(item)
+                if i != last:
+                    parts.append(sep)
+                continue
+            mark = 0
+            if group.name is not None:
+                parts.append(group.name)
+                variables[group.name] = None
+                writes += 1
+                written[group.name] = mark = writes
+                parts = []
+            stack.append((enumerate(group.items), len(group.items) - 1,
+                          parts, group.name, mark))
+            break
         else:
-            return self.getItem(key, flattend)
+            stack.pop()
+            if not stack:
+                S = String("".join(parts).strip())
+                S.variables.update(variables)
+                return S
+            if name is not None:
+                text = "".join(parts)
+                # unless a nested Variable with the same name wrote it
+                if written[name] == mark:
+                    variables[name] = text
+            elif stack[-1][1] != 0:
+                parts.append(endline)
 
-    def __setitem__(self, key, value, flattend = True):
+class _ListIndex():
+    """
+    index of the (nested) variables and static items of a patlang List
+
+    names maps the name of each List.Variable to the variables carrying it,
+    items maps each static item to the Lists directly containing it. Both
+    count the number of ways the indexed List contains them and are only
+    kept when enabled. The List keeps them up to date through _changed,
+    names and items are expected not to change in place.
+    """
+
+    def __init__(self):
+        self.names = None
+        self.items = None
+
+    def enable(self, root, variables=False, items=False):
         """
-        will set a nested (if flattend) variable (if key is variable) or item whose name is matching the key
+        start indexing the variables and/or items of root
         """
-        if isinstance(key, List.Variable):
-            self.setVariable(key.name, value, flattend)
-        else:
-            self.setItem(key, value, flattend)
-
-    def __add__(self, other):
-        pat = self.copy()
-        if type(other) is List:
-            pat.extend(other)
-        else:
-            pat.append(other)
-        return pat
+        names = variables and self.names is None
+        if names:
+            self.names = dict()
+        statics = items and self.items is None
+        if statics:
+            self.items = dict()
+        if names or statics:
+            for parent, item in List._walk(root, root):
+                self._add(parent, item, 1, names, statics)
 
-    def __iadd__(self, other):
+    def add(self, parent, item, count):
         """
-        return __add__
+        add (or remove if count is negative) count occurrences of item
         """
-        return self.__add__(other)
+        self._add(parent, item, count,
+                  self.names is not None, self.items is not None)
 
-    def __sub__(self, other):
-        return (self.copy()).__isub__(other)
+    def _add(self, parent, item, count, names, statics):
+        if type(item) is List.Variable:
+            if names:
+                self._count(self.names, _hashkey(item.name), item, count)
+        elif not isinstance(item, List):
+            if statics:
+                self._count(self.items, _hashkey(item), parent, count)
 
-    def __isub__(self, other):
+    @staticmethod
+    def _count(index, key, value, count):
+        bucket = index.setdefault(key, dict())
+        entry = bucket.get(id(value))
+        if entry is None:
+            bucket[id(value)] = entry = [value, 0]
+        entry[1] += count
+        if entry[1] <= 0:
+            del bucket[id(value)]
+            if not bucket:
+                del index[key]
+
+    @staticmethod
+    def _lookup(index, key):
         """
-        return __sub__
+        returns the values indexed under key (and under _UNHASHABLE), or None
+        if key cannot be looked up
         """
-        for i in range(len(self)-1, -1, -1):
-            print(list.__getitem__(self,i), i)
-            if list.__getitem__(self,i) == other:
-                del self[i:i+1]
-            elif (isinstance(list.__getitem__(self,i), List.Variable)
-                  and isinstance(other, List.Variable)):
-                if list.__getitem__(self,i).name == other.name:
-                    del self[i:i+1]
-            elif isinstance(list.__getitem__(self,i), List):
-                item = list.__getitem__(self,i)
-                item -= other
-        return self
+        hkey = _hashkey(key)
+        if index is None or hkey is _UNHASHABLE:
+            return None
+        values = [value for value, _ in index.get(hkey, dict()).values()]
+        if _UNHASHABLE in index:
+            values += [value for value, _ in index[_UNHASHABLE].values()]
+        return values
 
-    def __contains__(self, key, flattend=True):
+    def variables(self, key):
         """
-        if __getitem__ returns a valid item, this returns True
+        returns the variables named key, or None if key cannot be looked up
         """
-        if self.__getitem__(key, flattend):
-            return True
-        return False
-    
-    def __str__(self):
+        variables = self._lookup(self.names, key)
+        if variables is None:
+            return None
+        return [var for var in variables if var.name == key]
+
+    def parents(self, key):
         """
-        return serialized string of self
+        returns the Lists that may directly contain static item key, or None
+        if key cannot be looked up
         """
-        return "" + "".join(map(str, self)) + ""
+        if isinstance(key, List):
+            return None
+        return self._lookup(self.items, key)
 
-    def __repr__(self):
+    def contains(self, item):
         """
-        return serialized repr of self
+        True if item is (still) an indexed variable
         """
-        return "[" + ",".join(map(repr, self)) + "]"
+        return id(item) in self.names.get(_hashkey(item.name), dict())
 
-    def _copy(self, newList):
+    def getItem(self, root, key):
         """
-        private copy, because self_type cannot be given as default argument
+        getItem of root, only visiting the Lists that lead to a match
         """
-        for item in self:
-            if hasattr(item, "copy"):
-                newList.append(item.copy())
-            else:
-                newList.append(item)
-        return newList
+        parents = self.parents(key)
+        if parents is None:
+            return root._getItem(key, True, None)
+        if not parents:
+            return None
+        spine = root._spine(parents)
+        spine.update(map(id, parents))
+        return root._getItem(key, True, spine)
 
-    def copy(self):
+    def setItem(self, root, key, value):
         """
-        returns a copy of self as Pattern(self)
-        """ 
-        return self._copy(List())
+        setItem of root, only visiting the Lists containing a match, returns
+        False if key cannot be looked up
+        """
+        parents = self.parents(key)
+        if parents is None:
+            return False
+        for parent in parents:
+            # skip Lists no longer in root
+            if parent is root or id(parent) in self.items.get(
+                    _hashkey(key), dict()):
+                for index, item in enumerate(parent):
+                    if item == key:
+                        parent._replace(index, value)
+        return True
 
-    def setItem(self, key, value, flattend=True):
+    def getVariable(self, root, key):
         """
-        set static item
-        """ 
-        for index, item in enumerate(self):
-            if item == key:
-                super().__setitem__(index, value)
+        getVariable of root, only visiting the Lists that lead to a match
+        """
+        variables = self.variables(key)
+        if variables is None:
+            return root._getVariable(key, True, None)
+        if not variables:
+            return None
+        if len(variables) == 1:
+            # only an empty nested variable would be passed over
+            item = variables[0]
+            if item or id(root) in (item._parents or ()):
+                return item
+        return root._getVariable(key, True, root._spine(variables))
+
+    def setVariable(self, root, key, value):
+        """
+        setVariable of root, only visiting the matching variables, returns
+        False if key cannot be looked up
+        """
+        variables = self.variables(key)
+        if variables is None:
+            return False
+        for item in variables:
+            # skip variables emptied by setting an enclosing one
+            if self.contains(item):
+                item._set(value)
+        return True
+
+class List(list):
+    """
+    a patlang List
+    """
+
+    # Lists that contain self {id(list): [weakref(list), count]}, only
+    # recorded once self is tracked: it, or a List containing it, has an
+    # index or a cached rendering (see _track)
+    _parents = None
+    _tracked = False
+    # True when self, or a List containing it, has an index
+    _indexed = False
+    # optional _ListIndex of the (nested) variables in self
+    _index = None
+    # cached serialized string, None when outdated or not cacheable
+    _rendered = None
+
+    def __init__(self, *args):
+        """
+        Init a Pattern (list) with *args
+        """
+        self.variables = dict()
+        super().__init__(args)
+        self._added(args)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_parents", None)
+        state.pop("_tracked", None)
+        state.pop("_indexed", None)
+        state.pop("_rendered", None)
+        index = state.pop("_index", None)
+        if index is not None:
+            state["_index"] = (index.names is not None,
+                               index.items is not None)
+        return state
+
+    def __setstate__(self, state):
+        index = state.pop("_index", None)
+        self.__dict__.update(state)
+        if index:
+            self._enableIndex(*index)
+
+    @staticmethod
+    def _walk(parent, items):
+        """
+        yield (parent, item) for items and every nested item in them
+        """
+        stack = [(parent, iter(items))]
+        while stack:
+            parent, items = stack[-1]
+            for item in items:
+                yield parent, item
+                if isinstance(item, List):
+                    stack.append((item, iter(item)))
+                    break
+            else:
+                stack.pop()
+
+    def _link(self, parent, count):
+        """
+        register (or unregister if count is negative) parent as container
+        """
+        if self._parents is None:
+            self._parents = dict()
+        parents = self._parents
+        key = id(parent)
+        entry = parents.get(key)
+        if entry is None or entry[0]() is not parent:
+            # a dead parent may have left its entry under a reused id
+            def dropped(ref):
+                if parents.get(key, (None,))[0] is ref:
+                    del parents[key]
+            parents[key] = entry = [weakref.ref(parent, dropped), 0]
+        entry[1] += count
+        if entry[1] <= 0:
+            del parents[key]
+
+    def _track(self, indexed=False):
+        """
+        record self as parent of its nested Lists, and so on down, so their
+        changes reach self, indexed marks them as contained by an index
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            linked = node._tracked
+            node._tracked = True
+            if indexed:
+                node._indexed = True
+            for item in list.__iter__(node):
+                if isinstance(item, List):
+                    if not linked:
+                        item._link(node, 1)
+                    if not item._tracked or (indexed and not item._indexed):
+                        stack.append(item)
+
+    def _parentlists(self):
+        """
+        returns [(parent, count)] of the Lists containing self
+        """
+        if not self._parents:
+            return []
+        parents = []
+        for ref, count in list(self._parents.values()):
+            parent = ref()
+            if parent is not None:
+                parents.append((parent, count))
+        return parents
+
+    def _ancestors(self):
+        """
+        returns [(list, paths)] for self and every List containing self
+        (nested), where paths is the number of ways list contains self
+        """
+        if not self._parents:
+            return [(self, 1)]
+
+        # reverse post-order over the parents, so a List comes before the
+        # Lists containing it
+        order = []
+        visited = {id(self)}
+        stack = [(self, iter(self._parentlists()))]
+        while stack:
+            node, parents = stack[-1]
+            for parent, _ in parents:
+                if id(parent) not in visited:
+                    visited.add(id(parent))
+                    stack.append((parent, iter(parent._parentlists())))
+                    break
+            else:
+                order.append(node)
+                stack.pop()
+        order.reverse()
+
+        paths = {id(self): 1}
+        for node in order:
+            for parent, count in node._parentlists():
+                paths[id(parent)] = (paths.get(id(parent), 0)
+                                     + paths[id(node)] * count)
+        return [(node, paths[id(node)]) for node in order]
+
+    def _spine(self, items):
+        """
+        returns the ids of the Lists in self that (nested) contain items
+        """
+        spine = set()
+        stack = list(items)
+        while stack:
+            node = stack.pop()
+            for parent, _ in node._parentlists():
+                if id(parent) not in spine:
+                    spine.add(id(parent))
+                    if parent is not self:
+                        stack.append(parent)
+        return spine
+
+    def _changed(self, items, count):
+        """
+        update the Lists containing self for added (count > 0) or removed
+        (count < 0) items, and mark them to be rendered again
+        """
+        if not self._tracked:
+            # no index or cached rendering holds self
+            return
+        # a List only caches its rendering while all nested Lists do, so the
+        # walk up can stop at the first List without one
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._rendered is not None:
+                node._rendered = None
+                stack.extend(parent for parent, _ in node._parentlists()
+                             if parent._rendered is not None)
+        if not self._indexed:
+            return
+        for node, paths in self._ancestors():
+            if node._index is not None:
+                for parent, item in List._walk(self, items):
+                    node._index.add(parent, item, count * paths)
+
+    def _added(self, items):
+        if self._tracked:
+            for item in items:
+                if isinstance(item, List):
+                    item._link(self, 1)
+                    if not item._tracked or (self._indexed
+                                             and not item._indexed):
+                        item._track(self._indexed)
+        self._changed(items, 1)
+
+    def _removed(self, items):
+        if self._tracked:
+            for item in items:
+                if isinstance(item, List):
+                    item._link(self, -1)
+        self._changed(items, -1)
+
+    def append(self, item):
+        super().append(item)
+        self._added((item,))
+
+    def extend(self, items):
+        items = tuple(items)
+        super().extend(items)
+        self._added(items)
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._added((item,))
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._removed((item,))
+        return item
+
+    def remove(self, item):
+        self.pop(super().index(item))
+
+    def clear(self):
+        items = tuple(self)
+        super().clear()
+        self._removed(items)
+
+    def __delitem__(self, key):
+        items = list.__getitem__(self, key)
+        if not isinstance(key, slice):
+            items = (items,)
+        super().__delitem__(key)
+        self._removed(items)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed((), 0)
+
+    def reverse(self):
+        super().reverse()
+        self._changed((), 0)
+
+    def __imul__(self, n):
+        if n > 0:
+            self.extend(list(self) * (n - 1))
+        else:
+            self.clear()
+        return self
+
+    def _replace(self, index, value):
+        """
+        replace the item at index with value
+        """
+        item = list.__getitem__(self, index)
+        super().__setitem__(index, value)
+        self._removed((item,))
+        self._added((value,))
+
+    def _set(self, value):
+        """
+        replace the content of self by value (or the items of a List value)
+        """
+        self.clear()
+        if type(value) is List:
+            self.extend(value)
+        else:
+            self.append(value)
+
+    def _enableIndex(self, variables=False, items=False):
+        if self._index is None:
+            self._index = _ListIndex()
+            self._track(True)
+        self._index.enable(self, variables, items)
+        return self
+
+    def compile(self):
+        """
+        returns self frozen as CompiledList, for rendering with many
+        variable values
+        """
+        return CompiledList(self)
+
+    def indexVariables(self):
+        """
+        keep an index of the (nested) variables, so getVariable and
+        setVariable only visit the matching variables, returns self
+        """
+        return self._enableIndex(variables=True)
+
+    def indexItems(self):
+        """
+        keep an index of the (nested) static items, so getItem, setItem and
+        'in' only visit the Lists containing a match, returns self
+        """
+        return self._enableIndex(items=True)
+        
+    def __getitem__(self, key, flattend = True):
+        """
+        will return a nested (if flattend) variable (if key is variable) or item whose name is matching the key
+        """            
+        if isinstance(key, slice):
+            items = super().__getitem__(key)
+            newPat = List()
+            for item in items:
+                newPat.append(item)
+            return newPat
+
+        if isinstance(key, List.Variable):
+            return self.getVariable(key.name, flattend)
+        else:
+            return self.getItem(key, flattend)
+
+    def __setitem__(self, key, value, flattend = True):
+        """
+        will set a nested (if flattend) variable (if key is variable) or item whose name is matching the key
+        """
+        if isinstance(key, slice):
+            items = list.__getitem__(self, key)
+            value = tuple(value)
+            super().__setitem__(key, value)
+            self._removed(items)
+            self._added(value)
+        elif isinstance(key, List.Variable):
+            self.setVariable(key.name, value, flattend)
+        else:
+            self.setItem(key, value, flattend)
+
+    def __add__(self, other):
+        pat = self.copy()
+        if type(other) is List:
+            pat.extend(other)
+        else:
+            pat.append(other)
+        return pat
+
+    def __iadd__(self, other):
+        """
+        return __add__
+        """
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        return (self.copy()).__isub__(other)
+
+    def __isub__(self, other):
+        """
+        return __sub__
+        """
+        for i in range(len(self)-1, -1, -1):
+            print(list.__getitem__(self,i), i)
+            if list.__getitem__(self,i) == other:
+                del self[i:i+1]
+            elif (isinstance(list.__getitem__(self,i), List.Variable)
+                  and isinstance(other, List.Variable)):
+                if list.__getitem__(self,i).name == other.name:
+                    del self[i:i+1]
+            elif isinstance(list.__getitem__(self,i), List):
+                item = list.__getitem__(self,i)
+                item -= other
+        return self
+
+    def __contains__(self, key, flattend=True):
+        """
+        if __getitem__ returns a valid item, this returns True
+        """
+        if self.__getitem__(key, flattend):
+            return True
+        return False
+    
+    def __str__(self):
+        """
+        return serialized string of self, cached until self (or a nested List)
+        changes, as long as all nested items are str
+        """
+        if self._rendered is not None:
+            return self._rendered
+        out = []
+        static = True
+        for item in self:
+            out.append(str(item))
+            if type(item) is not str and not (isinstance(item, List)
+                                              and item._rendered is not None):
+                static = False
+        out = "".join(out)
+        if static:
+            self._track()
+            self._rendered = out
+        return out
+
+    def iter_chunks(self):
+        """
+        yield the serialized string of self in fragments
+        """
+        if self._rendered is not None:
+            yield self._rendered
+            return
+        stack = [iter(self)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, List) and item._rendered is not None:
+                    yield item._rendered
+                elif isinstance(item, List):
+                    stack.append(iter(item))
+                    break
+                elif hasattr(item, "iter_chunks"):
+                    yield from item.iter_chunks()
+                else:
+                    yield str(item)
+            else:
+                stack.pop()
+
+    def render_to(self, fileobj):
+        """
+        write the serialized string of self to fileobj
+        """
+        for chunk in self.iter_chunks():
+            fileobj.write(chunk)
+
+    def __repr__(self):
+        """
+        return serialized repr of self
+        """
+        return "[" + ",".join(map(repr, self)) + "]"
+
+    def _copy(self, newList):
+        """
+        private copy, because self_type cannot be given as default argument
+        """
+        if self._index is not None:
+            newList._enableIndex(self._index.names is not None,
+                                 self._index.items is not None)
+        for item in self:
+            if hasattr(item, "copy"):
+                newList.append(item.copy())
+            else:
+                newList.append(item)
+        return newList
+
+    def copy(self):
+        """
+        returns a copy of self as Pattern(self)
+        """ 
+        return self._copy(List())
+
+    def setItem(self, key, value, flattend=True):
+        """
+        set static item
+        """ 
+        if flattend and self._index is not None:
+            if self._index.setItem(self, key, value):
+                return
+
+        for index, item in enumerate(self):
+            if item == key:
+                self._replace(index, value)
             else:
                 if isinstance(item, List) and flattend:
                     item[key] = value
@@ -327,12 +1449,24 @@ class List(list):
         """
         get static item
         """  
+        if flattend and self._index is not None:
+            return self._index.getItem(self, key)
+        return self._getItem(key, flattend, None)
+
+    def _getItem(self, key, flattend, spine):
+        """
+        private getItem, if spine is given only Lists in spine are visited
+        """
         for item in self:
             if item == key:
                 return item
             else:
-                if isinstance(item, List) and flattend:
-                    n = item[key]
+                if (isinstance(item, List) and flattend
+                    and (spine is None or id(item) in spine)):
+                    if spine is None:
+                        n = item[key]
+                    else:
+                        n = item._getItem(key, True, spine)
                     if n: return n;
 
     def setVariable(self, key, value, flattend=True):
@@ -355,15 +1489,15 @@ class List(list):
         # setVariable(getVariable().name, getVariable().value) or use flush(key)
 
         # or should one not use flatten at that point?
+
+        if flattend and self._index is not None:
+            if self._index.setVariable(self, key, value):
+                return
         
         for item in self:
             if type(item) is List.Variable:
                 if item.name == key:
-                    item.clear()
-                    if type(value) is List:
-                        item.extend(value)
-                    else:
-                        item.append(value)
+                    item._set(value)
                 elif flattend:
                     item.setVariable(key, value)
             elif isinstance(item, List) and flattend:
@@ -375,16 +1509,25 @@ class List(list):
         """
 
         # which variable? it returns just the first and that may be a flaw.
-         
+
+        if flattend and self._index is not None:
+            return self._index.getVariable(self, key)
+        return self._getVariable(key, flattend, None)
+
+    def _getVariable(self, key, flattend, spine):
+        """
+        private getVariable, if spine is given only Lists in spine are visited
+        """
         for item in self:
             if type(item) is List.Variable:
                 if item.name == key:
                     return item
-                elif flattend:
-                    n = item.getVariable(key)
+                elif flattend and (spine is None or id(item) in spine):
+                    n = item._getVariable(key, True, spine)
                     if n: return n;
-            elif isinstance(item, List) and flattend:
-                n = item.getVariable(key)
+            elif (isinstance(item, List) and flattend
+                  and (spine is None or id(item) in spine)):
+                n = item._getVariable(key, True, spine)
                 if n: return n;
 
     def flush(self, key, flattend=True):
@@ -394,6 +1537,33 @@ class List(list):
         var = getVariable(key, flattend)
         setVariable(var.name, var.value, flattend)
 
+    def stats(self):
+        """
+        returns a summary of self: the items of self and its nested Lists
+        (nodes), the nesting of the Lists (depth), the number of variables
+        and the bytes of the str items
+        """
+        nodes = variables = size = 0
+        depth = 1
+        stack = [(iter(self), 1)]
+        while stack:
+            items, level = stack[-1]
+            for item in items:
+                nodes += 1
+                if isinstance(item, List):
+                    if isinstance(item, List.Variable):
+                        variables += 1
+                    stack.append((iter(item), level + 1))
+                    depth = max(depth, level + 1)
+                    break
+                if isinstance(item, str):
+                    size += len(str.__str__(item).encode("utf-8",
+                                                         "surrogatepass"))
+            else:
+                stack.pop()
+        return {"nodes": nodes, "depth": depth, "variables": variables,
+                "bytes": size}
+
     def toTree(self, flattend=True):
         """
         convert to patlang Tree
@@ -417,32 +1587,13 @@ class List(list):
         """
         convert to patlang String
         """
-        def _toString(lst, flattend):
-            S = ""
-            variables = dict()
-            for i, item in enumerate(lst):
-                if isinstance(item, List.Variable):
-                    S += item.name
-                    s, nv = _toString(item, flattend)
-                    variables.update({item.name : s})
-                    variables.update(nv)
-                elif isinstance(item, List) and flattend:
-                    s, nv = _toString(item, flattend)
-                    S += s
-                    if len(lst) != 1:
-                        S += endline
-                    variables.update(nv)
-                else:
-                    S += item
-                    if i != (len(lst)-1):
-                        S += sep
-            return S, variables
+        def expand(item):
+            if isinstance(item, List.Variable):
+                return _Group(item.name, item)
+            if isinstance(item, List) and flattend:
+                return _Group(None, item)
 
-        S = String()
-        s, nv = _toString(self, flattend)
-        S += s.strip()
-        S.variables.update(nv)
-        return S
+        return _joinString(_Group(None, self), expand, sep, endline)
 
 class VariableList(List):
     """
@@ -473,107 +1624,1210 @@ class VariableList(List):
 # propper alias
 List.Variable = VariableList
 
-#------------------------------------------------------------------------------#
-#                                                                              #
-# Tree                                                                         #
-#                                                                              #
-#------------------------------------------------------------------------------#
+class _Slot():
+    """
+    a variable in a CompiledList, with the compiled content of the variable
+    """
 
-class Tree():
+    def __init__(self, name, default):
+        self.name = name
+        self.key = _hashkey(name)
+        self.default = default
+
+class CompiledList():
     """
-    Tree is a node to a 2D tree
+    a patlang List frozen into literal segments and variable slots, that can
+    be rendered with different variable values without copying the List
     """
 
-    def __init__(self, *args):
-        self._lower_node = None
-        self._next_node = None
-        self.value = None
-        if len(args) > 0: self._setmerge(*args);
+    def __init__(self, pattern):
+        self.segments = CompiledList._compile((pattern,))
 
-    def _addnext(self, value):
-        if self._next_node == None:
-            self._next_node = Tree(value)
-            return self._next_node
-        else:
-            if isinstance(value, Tree.Variable):
-                if isinstance(self._next_node, Tree.Variable):
-                    if self._next_node.name == value.name:
-                        return self._next_node
-            elif self._next_node.value == value:
-                return self._next_node
-            return self._next_node._addbelow(value)
+    @staticmethod
+    def _compile(items):
+        """
+        returns the segments of items, adjacent str are joined
+        """
+        segments = []
+        literal = []
+        for item in items:
+            if type(item) is str:
+                literal.append(item)
+                continue
+            if literal:
+                segments.append("".join(literal))
+                literal = []
+            if type(item) is List.Variable:
+                segments.append(_Slot(item.name, CompiledList._compile(item)))
+            elif isinstance(item, List):
+                segments.extend(CompiledList._compile(item))
+            else:
+                segments.append(item)
+        if literal:
+            segments.append("".join(literal))
+        return segments
 
-    def _addbelow(self, value):
-        if self._lower_node == None:
-            self._lower_node = Tree(value)
-            return self._lower_node
-        else:
-            if self._lower_node.value == value:
-                return self._lower_node
-            return self._lower_node._addbelow(value)
+    def render(self, bindings):
+        """
+        returns the serialized string of the pattern as if
+        setVariable(name, value) was called for each binding, in order, on a
+        copy of the pattern. bindings is a dict or an iterable of
+        (name, value), List names are matched by their tuple() form.
+        """
+        if hasattr(bindings, "items"):
+            bindings = bindings.items()
 
-    def _setmerge(self, value, *args):
-        node = self
+        # {key: (position, value, compiled value)}, the last binding of a
+        # name is the one that counts
+        bound = dict()
+        unhashable = []
+        for position, (name, value) in enumerate(bindings):
+            key = _hashkey(name)
+            if key is _UNHASHABLE:
+                unhashable.append((name, [position, value, None]))
+            else:
+                bound[key] = [position, value, None]
+        unhashable.reverse()
 
-        if node.value == None:
-            node.value = value
-        elif node.value == value:
-            pass
-        else:
-            node = node._addbelow(value)
-            
-        for arg in args:
-            node = node._addnext(arg)
+        out = []
+        self._render(self.segments, bound, unhashable, -1, out)
+        return "".join(out)
 
-        return node
+    def render_many(self, bindings):
+        """
+        yield render(b) for each b in bindings
+        """
+        for b in bindings:
+            yield self.render(b)
 
-    def _remove(self, value):
+    def _render(self, segments, bound, unhashable, after, out):
         """
-        private func used by __sub__, returns a copy minus given value
+        render segments into out, only bindings later than position after
+        are filled in (a value is only filled by the bindings after it)
         """
-        # should be able to have inplace sub, but what about the first element
-        # self cannot be reassigned
-        # for now _remove returns a copy
-        
-        newTree = Tree()
-        for path in self:
-            T = newTree
-            for item in path:
-                if isinstance(value, Tree.Variable):
-                    if isinstance(item, Tree.Variable):
-                        if value != item.name:
-                            T = T[item._remove(value)]
+        for segment in segments:
+            if type(segment) is str:
+                out.append(segment)
+            elif isinstance(segment, _Slot):
+                binding = None
+                if segment.key is _UNHASHABLE:
+                    for name, b in unhashable:
+                        if name == segment.name:
+                            binding = b
+                            break
+                else:
+                    binding = bound.get(segment.key)
+                if binding is None or binding[0] <= after:
+                    self._render(segment.default, bound, unhashable, after,
+                                 out)
+                    continue
+                position, value, compiled = binding
+                if compiled is None:
+                    if type(value) is List:
+                        compiled = CompiledList._compile(value)
+                    else:
+                        compiled = CompiledList._compile((value,))
+                    binding[2] = compiled
+                self._render(compiled, bound, unhashable, position, out)
+            else:
+                out.append(str(segment))
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Tree                                                                         #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+def _intern(value):
+    """
+    returns value interned if it is a str, so equal values share memory
+    """
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+_VARIABLE = object()
+
+def _matches(nodevalue, value):
+    """
+    True if a node with nodevalue stands for value, variables match by name
+    """
+    if isinstance(nodevalue, Tree.Variable) or isinstance(value, Tree.Variable):
+        return (isinstance(nodevalue, Tree.Variable)
+                and isinstance(value, Tree.Variable)
+                and nodevalue.name == value.name)
+    return nodevalue == value
+
+def _childkey(value):
+    """
+    returns the key of a node value in _Siblings, variables are keyed by name
+    """
+    if isinstance(value, Tree.Variable):
+        key = _hashkey(value.name)
+        if key is _UNHASHABLE:
+            return key
+        return (_VARIABLE, key)
+    if isinstance(value, Tree) and not value._frozen:
+        return _UNHASHABLE
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return _UNHASHABLE
+
+def _sortkey(value):
+    """
+    returns the key of value for sorting paths, values that match (as
+    _matches) get equal keys, variables by the key of their name, raises
+    TypeError for values without a consistent order
+    """
+    if isinstance(value, Tree.Variable):
+        return (3, _sortkey(value.name))
+    kind = type(value)
+    if kind is str:
+        return (2, value)
+    if kind is int or kind is bool or (kind is float and value == value):
+        return (1, value)
+    if kind is bytes:
+        return (4, value)
+    raise TypeError("cannot sort %r" % kind.__name__)
+
+class _Siblings(dict):
+    """
+    lookup by value of the nodes in a chain of sibling Tree nodes, kept by
+    the first node of the chain
+
+    Nodes appended to the chain by others are picked up from the tail, a
+    node of the chain changing its value in place drops the lookup (see
+    Tree._unsibling), it is rebuilt when needed.
+    """
+
+    __slots__ = ("tail", "unkeyed")
+
+    def __init__(self, head):
+        super().__init__()
+        self.build(head)
+
+    def build(self, head):
+        self.clear()
+        self.unkeyed = []
+        self.tail = None
+        self.extend(head)
+
+    def extend(self, node):
+        while node is not None:
+            key = _childkey(node.value)
+            if key is _UNHASHABLE or node.value is None:
+                self.unkeyed.append(node)
+            elif key not in self:
+                self[key] = node
+            self.tail = node
+            node = node._lower_node
+
+    def find(self, head, value):
+        """
+        returns the node in the chain matching value, or None
+        """
+        if self.tail._lower_node is not None:
+            self.extend(self.tail._lower_node)
+        key = _childkey(value)
+        if key is not _UNHASHABLE:
+            node = self.get(key)
+            if node is not None:
+                return node
+        for node in self.unkeyed:
+            if _matches(node.value, value):
+                return node
+        return None
+
+    def append(self, node):
+        self.tail._setlower(node)
+        self.extend(node)
+        return node
+
+# types of the node values kept in _TreeIndex.items
+_STATIC = (str, int, float, bool, bytes, type(None))
+
+class _Nested():
+    """
+    what the nested Trees of a _TreeIndex hold: values and names map each
+    static value and variable name to the nodes holding nested Trees that
+    hold it, partial lists the nodes holding nested Trees with frozen
+    (shared) nodes, which may hold anything
+    """
+
+    __slots__ = ("values", "names", "partial", "exact", "frozen",
+                 "__weakref__")
+
+    def __init__(self):
+        self.values = dict()
+        self.names = dict()
+        self.partial = []
+        self.exact = True
+        self.frozen = False
+
+    def tables(self):
+        return (self.values, self.names)
+
+class _TreeIndex():
+    """
+    index of the values of the nodes from a Tree node (root) on, kept on
+    the root
+
+    items maps each static value (str, numbers, bytes or None) to the nodes
+    holding it, names maps the name of each variable to the nodes holding
+    the variable and trees holds the nodes with Tree values, variables
+    included. All map id(node) to the node, inexact counts the nodes holding
+    other kinds of values, which the index cannot compare.
+
+    The changeable nodes of a Tree point (in _index) to the index covering
+    them, so a node changing its value or linking a new node updates it in
+    place (see Tree._assign and Tree._link). Other changes, as removal or
+    copying frozen nodes, drop the index of that Tree only.
+
+    What the nested Trees hold is derived from their indexes when needed
+    (nested). The index of a nested Tree keeps the indexes depending on it
+    (dependents, weakly with the ids of the nodes holding the nested Tree), a
+    value or name it starts or stops holding is passed on to them. Other
+    changes make them derive it again.
+
+    The index of a frozen Tree never changes. The index of a changeable Tree
+    stops at frozen (shared) nodes, regions tells it met some. Such Trees
+    are changed by walking them (see Tree._own), copying the frozen parts
+    that change.
+    """
+
+    __slots__ = ("root", "frozen", "regions", "trees", "names", "items",
+                 "inexact", "dependents", "_nested", "_distinct", "__weakref__")
+
+    def __init__(self, tree, cover):
+        self.root = tree
+        self.frozen = tree._frozen
+        self.regions = False
+        self.trees = dict()
+        self.names = dict()
+        self.items = dict()
+        self.inexact = 0
+        self.dependents = dict()
+        self._nested = None
+        self._distinct = None
+        # walk the nodes in path order, next nodes before lower nodes
+        nodes = [tree]
+        visited = 0
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            visited += 1
+            if node._frozen and not self.frozen:
+                self.regions = True
+                continue
+            if cover:
+                node._index = self
+            self.add(node)
+            nodes.append(node._lower_node)
+            nodes.append(node._next_node)
+        if _instrumenting:
+            _count("nodes", visited)
+
+    def live(self):
+        """
+        True while this index is the one kept on its root
+        """
+        return self.root._index is self
+
+    def add(self, node):
+        """
+        index the value of node
+        """
+        value = node.value
+        if isinstance(value, Tree):
+            self.trees[id(node)] = node
+            if isinstance(value, Tree.Variable):
+                self._insert(1, _hashkey(value.name), node)
+            self._enter(node)
+        elif type(value) in _STATIC:
+            self._insert(0, value, node)
+        else:
+            self.inexact += 1
+            if self.inexact == 1:
+                self._notify()
+
+    def discard(self, node):
+        """
+        drop the value of node from the index
+        """
+        value = node.value
+        if isinstance(value, Tree):
+            self._leave(node)
+            del self.trees[id(node)]
+            if isinstance(value, Tree.Variable):
+                self._delete(1, _hashkey(value.name), node)
+        elif type(value) in _STATIC:
+            self._delete(0, value, node)
+        else:
+            self.inexact -= 1
+            if self.inexact == 0:
+                self._notify()
+
+    def _tables(self):
+        return (self.items, self.names)
+
+    def _shows(self, space, key):
+        """
+        True if the indexed Tree holds key, a static value (space 0) or a
+        variable name (space 1), nested Trees included
+        """
+        if key in self._tables()[space]:
+            return True
+        nested = self._nested
+        return nested is not None and key in nested.tables()[space]
+
+    def _insert(self, space, key, node):
+        table = self._tables()[space]
+        nodes = table.get(key)
+        if nodes is not None:
+            nodes[id(node)] = node
+            return
+        shown = self._shows(space, key)
+        table[key] = {id(node): node}
+        if not shown:
+            self._show(space, key, True)
+
+    def _delete(self, space, key, node):
+        table = self._tables()[space]
+        nodes = table[key]
+        del nodes[id(node)]
+        if not nodes:
+            del table[key]
+            if not self._shows(space, key):
+                self._show(space, key, False)
+
+    def _show(self, space, key, shown):
+        """
+        tell the dependents this index started (or stopped) holding key
+        """
+        for ident, (ref, holders, nestedref) in list(self.dependents.items()):
+            index, nested = ref(), nestedref()
+            if (index is None or nested is None or index._nested is not nested
+                    or not index.live()):
+                # collected or derived again since, without this index
+                del self.dependents[ident]
+                continue
+            before = index._shows(space, key)
+            table = nested.tables()[space]
+            held = table.get(key)
+            if shown:
+                if held is None:
+                    held = table[key] = dict()
+                held.update((ident, index.trees[ident]) for ident in holders
+                            if ident in index.trees)
+            elif held is not None:
+                for i in holders:
+                    held.pop(i, None)
+                if not held:
+                    del table[key]
+            if index._shows(space, key) != before:
+                index._show(space, key, not before)
+
+    def _notify(self):
+        """
+        make the dependents derive what their nested Trees hold again, they
+        depend on this index again when they do
+        """
+        dependents = self.dependents
+        if dependents:
+            self.dependents = dict()
+            for ref, holders, nestedref in dependents.values():
+                index, nested = ref(), nestedref()
+                if (index is not None and nested is not None
+                        and index._nested is nested and index.live()):
+                    index._nested = None
+                    index._notify()
+
+    def _inside(self, node):
+        """
+        returns the index of the Tree held by node, what its nested Trees
+        hold and if it can tell this index when that changes
+        """
+        tree = node.value
+        index = tree._trees()
+        inner = index.nested()
+        partial = index.regions or bool(inner.partial)
+        exact = inner.exact and not index.inexact and not index.regions
+        tells = tree._frozen or index.live()
+        return index, inner, partial, exact, tells
+
+    def _enter(self, node):
+        """
+        add what the Tree held by node holds, the node is new in trees
+        """
+        nested = self._nested
+        if nested is None:
+            return
+        index, inner, partial, exact, tells = self._inside(node)
+        frozen = node.value._frozen and not self.frozen
+        if not tells:
+            self._nested = None
+            self._notify()
+            return
+        if ((partial and not nested.partial) or (nested.exact and not exact)
+                or (frozen and not nested.frozen)):
+            # the dependents cannot take this as a change of values
+            self._notify()
+        if partial:
+            nested.partial.append(node)
+        nested.exact = nested.exact and exact
+        nested.frozen = nested.frozen or frozen
+        if not node.value._frozen:
+            entry = index.dependents.get(id(self))
+            if (entry is None or entry[2]() is not nested
+                    or entry[0]() is not self):
+                entry = index._depend(self, set(), nested)
+            entry[1].add(id(node))
+        for space, table in enumerate(nested.tables()):
+            for keys in (index._tables()[space], inner.tables()[space]):
+                for key in keys:
+                    held = table.get(key)
+                    if held is None:
+                        before = self._shows(space, key)
+                        table[key] = {id(node): node}
+                        if not before:
+                            self._show(space, key, True)
+                    else:
+                        held[id(node)] = node
+
+    def _leave(self, node):
+        """
+        remove what the Tree held by node holds, the node is still in trees
+        """
+        nested = self._nested
+        if nested is None:
+            return
+        index, inner, partial, exact, tells = self._inside(node)
+        if partial or not exact or (node.value._frozen and not self.frozen):
+            # the flags it set may come from other nodes as well
+            self._nested = None
+            self._notify()
+            return
+        entry = index.dependents.get(id(self))
+        if (entry is not None and entry[2]() is nested
+                and entry[0]() is self):
+            entry[1].discard(id(node))
+            if not entry[1]:
+                del index.dependents[id(self)]
+        for space, table in enumerate(nested.tables()):
+            for keys in (index._tables()[space], inner.tables()[space]):
+                for key in list(keys):
+                    held = table.get(key)
+                    if held is None or held.pop(id(node), None) is None:
+                        continue
+                    if not held:
+                        del table[key]
+                        if not self._shows(space, key):
+                            self._show(space, key, False)
+
+    def _depend(self, index, holders, nested):
+        """
+        register index as dependent with what its nested Trees hold, both
+        referred to weakly (they refer to the nodes of the dependent Tree),
+        the entry is removed when index is collected, returns the entry
+        """
+        dependents = self.dependents
+        key = id(index)
+        def dropped(ref):
+            entry = dependents.get(key)
+            if entry is not None and entry[0] is ref:
+                del dependents[key]
+        entry = dependents[key] = (weakref.ref(index, dropped), holders,
+                                   weakref.ref(nested))
+        return entry
+
+    def link(self, node, replaced):
+        """
+        index node, just linked to a node covered by this index in place of
+        replaced (or None)
+        """
+        if (replaced is None and node._next_node is None
+                and node._lower_node is None and not node._frozen):
+            node._index = self
+            self.add(node)
+        else:
+            self.drop()
+
+    def drop(self):
+        """
+        remove this index from its root, it is built again when needed
+        """
+        if self.live():
+            self.root._index = None
+            self._notify()
+
+    def variables(self, name):
+        """
+        returns the nodes holding a variable named name
+        """
+        key = _hashkey(name)
+        nodes = self.names.get(key)
+        if not nodes:
+            return []
+        if key is _UNHASHABLE:
+            return [node for node in nodes.values() if node.value.name == name]
+        return list(nodes.values())
+
+    def carriers(self, name, flattend):
+        """
+        returns the nodes holding a variable named name and, with flattend,
+        the nodes holding nested Trees that (may) hold it
+        """
+        nodes = self.variables(name)
+        if flattend:
+            nested = self.nested()
+            held = list(nested.names.get(_hashkey(name), {}).values())
+            held.extend(nested.partial)
+            if held:
+                seen = set(map(id, nodes))
+                for node in held:
+                    if id(node) not in seen:
+                        seen.add(id(node))
+                        nodes.append(node)
+        return nodes
+
+    def holders(self, key, flattend):
+        """
+        returns the nodes holding static item key and, with flattend, the
+        nodes holding nested Trees that hold it, or None if the index cannot
+        tell
+        """
+        if type(key) not in _STATIC or self.regions or self.inexact:
+            return None
+        nodes = list(self.items.get(key, {}).values())
+        if flattend:
+            nested = self.nested()
+            if not nested.exact:
+                return None
+            nodes.extend(nested.values.get(key, {}).values())
+        return nodes
+
+    def distinct(self):
+        """
+        True if no chain of siblings in the indexed Tree holds two nodes with
+        the same value and no node holds an empty Tree, nested Trees
+        included, so Tree.remove has nothing to merge, kept for frozen Trees
+        """
+        if self._distinct is not None:
+            return self._distinct
+        distinct = True
+        heads = [self.root]
+        while heads and distinct:
+            node = heads.pop()
+            seen = set()
+            unkeyed = []
+            while node is not None:
+                value = node.value
+                if isinstance(value, Tree) and (value == Tree()
+                                                or not value._trees().distinct()):
+                    distinct = False
+                    break
+                key = _childkey(value)
+                if key is _UNHASHABLE or value is None or type(value) is Tree:
+                    if any(_matches(other, value) for other in unkeyed):
+                        distinct = False
+                        break
+                    unkeyed.append(value)
+                elif key in seen:
+                    distinct = False
+                    break
+                else:
+                    seen.add(key)
+                if node._next_node is not None:
+                    heads.append(node._next_node)
+                node = node._lower_node
+        if self.frozen:
+            self._distinct = distinct
+        return distinct
+
+    def branches(self):
+        """
+        True if the indexed Tree may hold Tree values
+        """
+        return bool(self.trees) or self.regions
+
+    @property
+    def shared(self):
+        """
+        True if the indexed Tree has frozen nodes or frozen Tree values
+        """
+        return self.regions or self.nested().frozen
+
+    def nested(self):
+        """
+        returns what the nested Trees hold (a _Nested), derived from their
+        indexes
+        """
+        if self._nested is not None:
+            return self._nested
+        nested = _Nested()
+        keep = self.live()
+        entries = dict()
+        for node in self.trees.values():
+            index, inner, partial, exact, tells = self._inside(node)
+            if not tells:
+                # not a root, its index is not kept so it cannot tell
+                keep = False
+            elif not node.value._frozen:
+                entry = entries.get(id(index))
+                if entry is None:
+                    entry = entries[id(index)] = (index, set())
+                entry[1].add(id(node))
+            if partial:
+                nested.partial.append(node)
+            nested.exact = nested.exact and exact
+            if node.value._frozen and not self.frozen:
+                nested.frozen = True
+            for space, table in enumerate(nested.tables()):
+                for keys in (index._tables()[space], inner.tables()[space]):
+                    for key in keys:
+                        held = table.get(key)
+                        if held is None:
+                            table[key] = {id(node): node}
                         else:
+                            held[id(node)] = node
+        if keep:
+            self._nested = nested
+            for index, holders in entries.values():
+                index._depend(self, holders, nested)
+        return nested
+
+class Tree():
+    """
+    Tree is a node to a 2D tree
+    """
+
+    # nodes are compact, without an instance __dict__, the first node of a
+    # long chain of siblings keeps a _Siblings lookup in _siblings, _up is
+    # the node linking to this one and _hash the cached structural hash of
+    # the nodes from here on (value, next and lower nodes), __weakref__ keeps
+    # Trees weakly referenceable
+    __slots__ = ("_lower_node", "_next_node", "value", "_siblings",
+                 "_up", "_hash", "_frozen", "_index", "__weakref__")
+
+    # length of a chain of siblings from which a _Siblings lookup is kept
+    _SIBLINGS = 8
+
+    def __init__(self, *args):
+        self._lower_node = None
+        self._next_node = None
+        self._siblings = None
+        self._up = None
+        self._hash = None
+        self._frozen = False
+        self._index = None
+        self.value = None
+        if len(args) > 0: self._setmerge(*args);
+
+    def _changed(self):
+        """
+        drop the cached hashes of self and the nodes linking to it
+        """
+        if self._frozen:
+            raise TypeError("a frozen Tree cannot be changed")
+        node = self
+        while node is not None and node._hash is not None:
+            node._hash = None
+            node = node._up
+
+    @staticmethod
+    def _leaf(value):
+        """
+        returns a new node holding value, as Tree(value)
+        """
+        node = Tree.__new__(Tree)
+        node._lower_node = node._next_node = None
+        node._siblings = node._up = node._hash = node._index = None
+        node._frozen = False
+        node.value = _intern(value)
+        return node
+
+    def _covering(self):
+        """
+        returns the _TreeIndex covering this node, or None
+        """
+        index = self._index
+        if index is not None and index.live():
+            return index
+        return None
+
+    def _assign(self, value):
+        """
+        set the value of this node, keeping the index covering it up to date
+        """
+        self._changed()
+        index = self._covering()
+        if index is None:
+            self.value = value
+            return
+        index.discard(self)
+        self.value = value
+        index.add(self)
+
+    def _setvalue(self, value):
+        """
+        change the value of this node in place
+        """
+        self._assign(value)
+        self._unsibling()
+
+    def _unsibling(self):
+        """
+        drop the _Siblings lookups of the chain of siblings self is in
+        """
+        node = self
+        node._siblings = None
+        while node._up is not None and node._up._lower_node is node:
+            node = node._up
+            node._siblings = None
+
+    def _link(self, attr, node):
+        """
+        link node to self by attr ('_next_node' or '_lower_node')
+        """
+        self._changed()
+        index = self._covering()
+        replaced = getattr(self, attr)
+        setattr(self, attr, node)
+        node._up = self
+        if index is not None:
+            index.link(node, replaced)
+        return node
+
+    def _setlower(self, node):
+        """
+        link node below self
+        """
+        return self._link("_lower_node", node)
+
+    def _setnext(self, node):
+        """
+        link node next to self
+        """
+        return self._link("_next_node", node)
+
+    def _clone(self):
+        """
+        returns a changeable copy of this node, linking the same nodes
+        """
+        node = Tree.__new__(type(self))
+        node._lower_node = self._lower_node
+        node._next_node = self._next_node
+        node._siblings = node._up = node._index = None
+        node._hash = self._hash
+        node._frozen = False
+        node.value = self.value
+        if isinstance(self, Tree.Variable):
+            node.name = self.name
+        return node
+
+    def _ownchain(self):
+        """
+        replace the frozen (shared) nodes below self in its chain of siblings
+        by changeable copies
+        """
+        node = self
+        while node._lower_node is not None:
+            if node._lower_node._frozen:
+                node._setlower(node._lower_node._clone())
+            node = node._lower_node
+
+    def _ownlink(self, attr):
+        """
+        returns the chain linked by attr ('_next_node' or '_lower_node') of
+        self, its frozen (shared) nodes replaced by changeable copies
+        """
+        node = getattr(self, attr)
+        if node is not None and node._frozen and not self._frozen:
+            if attr == "_next_node":
+                node = self._setnext(node._clone())
+            else:
+                node = self._setlower(node._clone())
+            node._ownchain()
+            if attr == "_lower_node":
+                self._unsibling()
+        return node
+
+    def _sibling(self, value):
+        """
+        returns the node matching value in the chain of siblings starting at
+        self, a new node is appended to the chain if there is none
+        """
+        if not self._frozen:
+            self._ownlink("_lower_node")
+
+        if self._siblings is not None:
+            node = self._siblings.find(self, value)
+            if node is None:
+                node = self._siblings.append(Tree._leaf(value))
+            return node
+
+        node = self
+        length = 1
+        while not _matches(node.value, value):
+            if node._lower_node is None:
+                node._setlower(Tree._leaf(value))
+                if length >= Tree._SIBLINGS:
+                    self._siblings = _Siblings(self)
+                return node._lower_node
+            node = node._lower_node
+            length += 1
+            if length > Tree._SIBLINGS:
+                # a long chain (its lookup was dropped), look it up instead
+                self._siblings = _Siblings(self)
+                return self._sibling(value)
+        return node
+
+    def _addnext(self, value):
+        if self._next_node is None:
+            return self._setnext(Tree._leaf(value))
+        return self._ownlink("_next_node")._sibling(value)
+
+    def _addbelow(self, value):
+        if self._lower_node is None:
+            return self._setlower(Tree._leaf(value))
+        return self._ownlink("_lower_node")._sibling(value)
+
+    def _setmerge(self, value, *args):
+        node = self
+
+        if node.value is None:
+            node._assign(_intern(value))
+            node._unsibling()
+        else:
+            node = node._sibling(value)
+            
+        for arg in args:
+            node = node._addnext(arg)
+
+        return node
+
+    @classmethod
+    def from_paths(cls, paths, sort=False):
+        """
+        returns a Tree of the iterable paths, equal to merging the paths
+        one by one, sort sorts the paths first (reading them all at once),
+        variables are sorted by name and of matching values (variables with
+        the same name, 1 and 1.0) the first in sorted order is kept
+
+        Consecutive paths share the nodes of their common prefix and only
+        the first value past it is looked up, paths from a generator are
+        read one at a time. Sorted paths need no lookups at all.
+        """
+        if sort:
+            paths = [tuple(path) for path in paths]
+            try:
+                paths.sort(key=lambda path: tuple(map(_sortkey, path)))
+            except TypeError:
+                # values without an order, merge the paths as they are
+                sort = False
+        tree = cls()
+        stack = []
+        for path in paths:
+            depth = 0
+            node = None
+            for value in path:
+                if node is None or node._next_node is not None:
+                    if depth < len(stack):
+                        last = stack[depth]
+                        if type(value) is str:
+                            same = last.value == value
+                        else:
+                            same = _matches(last.value, value)
+                        if same:
+                            # node of the prefix shared with the previous path
+                            node = last
+                            depth += 1
                             continue
-                        
-                if isinstance(item, Tree):
-                    if isinstance(value, Tree):
-                        if item != value:
-                            T = T[item._remove(value)]
+                        del stack[depth:]
+                    if not sort:
+                        if node is not None:
+                            node = node._addnext(value)
+                        elif tree.value is None:
+                            node = tree._setmerge(value)
+                        else:
+                            node = tree._sibling(value)
+                        stack.append(node)
+                        depth += 1
+                        continue
+                    if node is None and tree.value is None:
+                        node = tree._setmerge(value)
+                        stack.append(node)
+                        depth += 1
+                        continue
+                    # sorted, so value is new: append it to the siblings
+                    above = last
                 else:
-                    if item != value:
-                        T = T[item]
-        return newTree
+                    # below a new node, nothing to look up
+                    above = None
+                child = Tree._leaf(value)
+                if above is None:
+                    node._next_node = child
+                    child._up = node
+                else:
+                    above._lower_node = child
+                    child._up = above
+                node = child
+                stack.append(node)
+                depth += 1
+            del stack[depth:]
+        return tree
+
+    def remove(self, value):
+        """
+        remove the nodes with value in place, variables match by name
+
+        The nodes following a removed node take its place and are merged
+        with its siblings, nested Trees are searched too and nodes left with
+        an empty Tree are removed.
+        """
+        self._changed()
+        index = self._covering()
+        head = Tree._prune(self, value)
+        if head is not self:
+            self._become(head)
+        if index is not None:
+            index.drop()
+
+    @staticmethod
+    def _prune(head, value):
+        """
+        remove value from the chain of siblings starting at head and the
+        chains following it, returns the new first node of the chain
+
+        Frozen (shared) nodes are copied when their chain changes, chains of
+        frozen nodes without value or siblings to merge are kept as they are.
+        """
+        first = None
+        chains = [(None, [head])]
+        while chains:
+            parent, heads = chains.pop()
+            if (len(heads) == 1 and heads[0]._frozen and parent is not None
+                    and parent._next_node is heads[0]):
+                found = heads[0]._statics(value, True)
+                if (found is not None and len(found) == 0
+                        and heads[0]._trees().distinct()):
+                    continue
+            pending = collections.deque()
+            for node in heads:
+                while node is not None:
+                    pending.append(node._clone() if node._frozen else node)
+                    node = node._lower_node
+
+            kept = []
+            more = {}
+            seen = {}
+            unkeyed = []
+            while pending:
+                node = pending.popleft()
+                node._hash = None
+                node._siblings = None
+                if isinstance(node.value, Tree) and not _matches(node.value, value):
+                    node.value = Tree._pruned(node.value, value)
+                if _matches(node.value, value) or node.value == Tree():
+                    children = []
+                    child = node._next_node
+                    while child is not None:
+                        # placeholders only ended the path of the removed node
+                        if child.value is not None or child._next_node is not None:
+                            children.append(child._clone() if child._frozen else child)
+                        child = child._lower_node
+                    pending.extendleft(reversed(children))
+                    continue
+
+                # merge into an earlier sibling with the same value, Trees
+                # are compared as frozen and changeable ones can be equal
+                key = _childkey(node.value)
+                keyed = not (key is _UNHASHABLE or node.value is None
+                             or type(node.value) is Tree)
+                if not keyed:
+                    same = next((n for n in unkeyed
+                                 if _matches(n.value, node.value)), None)
+                else:
+                    same = seen.get(key)
+                if same is not None:
+                    if node._next_node is not None:
+                        more.setdefault(id(same), []).append(node._next_node)
+                    continue
+                if not keyed:
+                    unkeyed.append(node)
+                else:
+                    seen[key] = node
+                kept.append(node)
+
+            for above, node in zip(kept, kept[1:]):
+                above._lower_node = node
+                node._up = above
+            if kept:
+                kept[-1]._lower_node = None
+                kept[0]._up = parent
+            newhead = kept[0] if kept else None
+            if parent is None:
+                first = newhead
+            else:
+                parent._next_node = newhead
+            for node in reversed(kept):
+                heads = [node._next_node] if node._next_node is not None else []
+                heads.extend(more.get(id(node), ()))
+                if heads:
+                    chains.append((node, heads))
+        return first
+
+    @staticmethod
+    def _pruned(tree, value):
+        """
+        returns tree without value, frozen Trees are pruned as a copy
+        """
+        if tree._frozen:
+            copy = tree.copy()
+            copy.remove(value)
+            return tree if copy == tree else copy.freeze()
+        tree.remove(value)
+        return tree
+
+    def _become(self, node):
+        """
+        take over value and links of node, or become empty for None
+        """
+        up = self._up
+        if node is None:
+            node = Tree()
+        self.value = node.value
+        self._next_node = node._next_node
+        self._lower_node = node._lower_node
+        self._siblings = None
+        self._hash = None
+        for child in (self._next_node, self._lower_node):
+            if child is not None:
+                child._up = self
+        self._up = up
 
     def __eq__(self, other):
-        if isinstance(other, Tree):
-            for path in self:
-                for otherpath in other:
-                    for item, otheritem in zip(path, otherpath):
-                        if item != otheritem:
-                            return False
-            return True
-        return False
+        """
+        Trees are equal when their nodes are, in the same order, variables
+        also need the same name
+        """
+        if not isinstance(other, Tree):
+            return False
+        if isinstance(self, Tree.Variable) or isinstance(other, Tree.Variable):
+            if not (isinstance(self, Tree.Variable)
+                    and isinstance(other, Tree.Variable)
+                    and self.name == other.name):
+                return False
+        if self._structhash() != other._structhash():
+            return False
+        pairs = [(self, other)]
+        while pairs:
+            node, othernode = pairs.pop()
+            if node is othernode:
+                continue
+            if node is None or othernode is None:
+                return False
+            if not node.value == othernode.value:
+                return False
+            pairs.append((node._lower_node, othernode._lower_node))
+            pairs.append((node._next_node, othernode._next_node))
+        return True
+
+    def __hash__(self):
+        if not self._frozen:
+            raise TypeError("unhashable type: 'Tree', freeze it first")
+        return self._structhash()
+
+    def _structhash(self):
+        """
+        returns the structural hash of self and the nodes next to and below
+        it, hashes are cached on nodes without (nested) unfrozen Trees
+        """
+        if self._hash is not None:
+            return self._hash
+        # post-order walk, children are hashed before the nodes linking them
+        hashes = {}
+        stack = [(self, False)]
+        while stack:
+            node, ready = stack.pop()
+            if node is None or node._hash is not None:
+                continue
+            if not ready:
+                stack.append((node, True))
+                stack.append((node._lower_node, False))
+                stack.append((node._next_node, False))
+                continue
+            value = node.value
+            cacheable = True
+            if isinstance(value, Tree):
+                valuehash = value._structhash()
+                cacheable = value._frozen
+            else:
+                try:
+                    valuehash = hash(value)
+                except TypeError:
+                    valuehash = 0
+            name = node.name if isinstance(node, Tree.Variable) else None
+            try:
+                namehash = hash(name)
+            except TypeError:
+                namehash = 0
+            h = hash((namehash, valuehash,
+                      Tree._hashof(node._next_node, hashes),
+                      Tree._hashof(node._lower_node, hashes)))
+            for child in (node._next_node, node._lower_node):
+                if child is not None and child._hash is None:
+                    cacheable = False
+            if cacheable:
+                node._hash = h
+            else:
+                hashes[id(node)] = h
+        return Tree._hashof(self, hashes)
+
+    @staticmethod
+    def _hashof(node, hashes):
+        if node is None:
+            return 0
+        if node._hash is not None:
+            return node._hash
+        return hashes[id(node)]
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def freeze(self):
+        """
+        make self and the Trees in its values read-only and hashable,
+        returns self
+        """
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if node is None or node._frozen:
+                continue
+            if node._index is not None:
+                # its own index or the one covering it, built again frozen
+                node._index.drop()
+            node._frozen = True
+            if isinstance(node.value, Tree):
+                nodes.append(node.value)
+            nodes.append(node._next_node)
+            nodes.append(node._lower_node)
+        return self
             
     def __getitem__(self, key):
         node = self._setmerge(key)
         if not node._next_node:
             node._addnext(None)
-        return node._next_node
+        return node._ownlink("_next_node")
 
     def __setitem__(self, key, value):
         node = self._setmerge(key)
-        node.value = value
+        node._setvalue(value)
         return node
 
     def __add__(self, other):
@@ -586,73 +2840,128 @@ class Tree():
         return self
         
     def __sub__(self, other):
-        return self._remove(other)
+        n = self.copy()
+        n.remove(other)
+        return n
+
+    def __isub__(self, other):
+        self.remove(other)
+        return self
+
+    def _statics(self, key, flattend):
+        """
+        returns the nodes holding key, with flattend also the nodes holding
+        nested Trees that hold it, or None if the index cannot answer
+        """
+        return self._trees().holders(key, flattend)
 
     def __contains__(self, value, flattend=True):
+        found = self._statics(value, flattend)
+        if found is not None:
+            return len(found) > 0
+        visited = 0
         lower_nodes = [self]
-        while len(lower_nodes) > 0:
-            node = lower_nodes.pop()
-            while node != None:
-                if node._lower_node:
-                    lower_nodes.append(node._lower_node)
-                    
-                if isinstance(value, Tree.Variable):
-                    if isinstance(node.value, Tree.Variable):
-                        if value.name == node.value.name:
+        try:
+            while len(lower_nodes) > 0:
+                node = lower_nodes.pop()
+                while node != None:
+                    visited += 1
+                    if node._frozen and not self._frozen:
+                        # shared nodes, from here on they have their own index
+                        if node.__contains__(value, flattend):
                             return True
+                        break
+                    if node._lower_node:
+                        lower_nodes.append(node._lower_node)
 
-                if isinstance(value, Tree):
-                    if isinstance(node.value, Tree):
-                        if value.value == node.value.value:
-                            return True
-                else:
-                    if isinstance(node.value, Tree) and flattend:
-                        if value in node.value:
-                            return True
+                    if isinstance(value, Tree.Variable):
+                        if isinstance(node.value, Tree.Variable):
+                            if value.name == node.value.name:
+                                return True
+
+                    if isinstance(value, Tree):
+                        if isinstance(node.value, Tree):
+                            if value.value == node.value.value:
+                                return True
                     else:
-                        if node.value == value:
-                            return True
+                        if isinstance(node.value, Tree) and flattend:
+                            if value in node.value:
+                                return True
+                        else:
+                            if node.value == value:
+                                return True
 
-                node = node._next_node
-        return False
+                    node = node._next_node
+            return False
+        finally:
+            if _instrumenting:
+                _count("nodes", visited)
 
     def __iter__(self):
-        self.routes = [(self,[])]
-        return self
+        """
+        yield the values of each path as a List
+        """
+        for path in self.iter_paths():
+            L = List()
+            L.extend(path)
+            yield L
 
-    def __next__(self):
-        if len(self.routes) > 0:
-            node, path = self.routes.pop()
-            while node != None:
-                if node._lower_node != None:
-                    self.routes.append((node._lower_node, list(path)))
-                path.append(node)
+    def iter_paths(self):
+        """
+        yield the values of each path as a tuple
 
+        The state of the walk is local to the generator, so walks over the
+        same tree can be nested or run from several threads. Branches share
+        their prefix as a linked (node, prefix) pair, nothing is copied at a
+        branch and each path is built once when it is yielded.
+        """
+        routes = [(self, None)]
+        while routes:
+            node, prefix = routes.pop()
+            while node is not None:
+                if node._lower_node is not None:
+                    routes.append((node._lower_node, prefix))
+                prefix = (node, prefix)
                 node = node._next_node
-            L = List()
-            L.extend([i.value for i in path if i.value != None])
-            return L
-        else:
-            raise StopIteration
+            path = []
+            while prefix is not None:
+                node, prefix = prefix
+                if node.value is not None:
+                    path.append(node.value)
+            path.reverse()
+            yield tuple(path)
     
     def __str__(self):
         """
         return serialized string of self
         """
-        out = ""
-        for path in self:
+        return "".join(self.iter_chunks())
+
+    def iter_chunks(self):
+        """
+        yield the serialized string of self in fragments
+        """
+        for path in self.iter_paths():
             for item in path:
                 if item != None:
-                    out += str(item)
+                    if hasattr(item, "iter_chunks"):
+                        yield from item.iter_chunks()
+                    else:
+                        yield str(item)
 
-        return out
+    def render_to(self, fileobj):
+        """
+        write the serialized string of self to fileobj
+        """
+        for chunk in self.iter_chunks():
+            fileobj.write(chunk)
 
     def __repr__(self):
         """
         return serialized repr of self
         """
         out = []
-        for path in self:
+        for path in self.iter_paths():
             l = []
             for item in path:
                 l.append(repr(item))
@@ -664,81 +2973,220 @@ class Tree():
         """
         private copy, cause self_type cannot be as default argument
         """
-        for path in self:
-            T = newTree
-            for item in path:
-                if isinstance(item, Tree):
-                    T = T[item.copy()]
-                else:
-                    T = T[item]
+        pairs = [(self, newTree)]
+        while pairs:
+            node, newnode = pairs.pop()
+            value = node.value
+            if isinstance(value, Tree):
+                value = value.copy()
+            newnode.value = value
+            # frozen nodes are shared, they are copied once changed
+            for attr in ("_next_node", "_lower_node"):
+                child = getattr(node, attr)
+                if child is not None and child._frozen:
+                    setattr(newnode, attr, child)
+                elif child is not None:
+                    pairs.append((child, Tree()))
+                    if attr == "_next_node":
+                        newnode._setnext(pairs[-1][1])
+                    else:
+                        newnode._setlower(pairs[-1][1])
         return newTree
 
     def copy(self):
+        """
+        returns a copy of self, a frozen Tree is copied without copying its
+        nodes, they are shared until changed
+        """
+        if self._frozen:
+            return self._clone()
         return self._copy(Tree())
 
     def setItem(self, key, value, flattend=True):
         """
         set static item
         """
-        lower_nodes = [self]
-        while len(lower_nodes) > 0:
-            node = lower_nodes.pop()
-            while node != None:
-                if node._lower_node:
-                    lower_nodes.append(node._lower_node)
-
-                if isinstance(node.value, Tree) and flattend:
-                    node.value.setItem(key, value);
-                else:
-                    if node.value == key:
-                        node.value = value
+        if not self._trees().shared:
+            found = self._statics(key, flattend)
+            if found is not None:
+                for node in found:
+                    if isinstance(node.value, Tree):
+                        # a nested Tree can hold frozen (shared) nodes itself
+                        node.value.setItem(key, value)
+                    else:
+                        node._setvalue(value)
+                return
+        for node in self._own(lambda tree: tree._holdsItem(key, flattend)):
+            if isinstance(node.value, Tree) and flattend:
+                node.value.setItem(key, value);
+            else:
+                if node.value == key:
+                    node._setvalue(value)
 
-                node = node._next_node
+    def _holdsItem(self, key, flattend):
+        """
+        False if self does not hold static item key
+        """
+        found = self._statics(key, flattend)
+        return found is None or len(found) > 0
 
     def getItem(self, key, flattend=True):
         """
         get static item
         """
+        found = self._statics(key, flattend)
+        # the first of more nodes in path order is found by walking
+        if found is not None and len(found) < 2:
+            for node in found:
+                if not isinstance(node.value, Tree):
+                    return node
+                n = node.value.getItem(key)
+                if n: return n;
+            return None
+        visited = 0
         lower_nodes = [self]
-        while len(lower_nodes) > 0:
-            node = lower_nodes.pop()
-            while node != None:
-                if node._lower_node:
-                    lower_nodes.append(node._lower_node)
-
-                if isinstance(node.value, Tree) and flattend:
-                    n = node.value.getItem(key);
-                    if n: return n;
-                else:
-                    if node.value == key:
-                        return node
+        try:
+            while len(lower_nodes) > 0:
+                node = lower_nodes.pop()
+                while node != None:
+                    visited += 1
+                    if node._frozen and not self._frozen:
+                        # shared nodes, from here on they have their own index
+                        n = node.getItem(key, flattend)
+                        if n: return n;
+                        break
+                    if node._lower_node:
+                        lower_nodes.append(node._lower_node)
 
-                node = node._next_node
+                    if isinstance(node.value, Tree) and flattend:
+                        n = node.value.getItem(key);
+                        if n: return n;
+                    else:
+                        if node.value == key:
+                            return node
+
+                    node = node._next_node
+        finally:
+            if _instrumenting:
+                _count("nodes", visited)
+
+    def _trees(self):
+        """
+        returns the _TreeIndex of self, built when there is none
+        """
+        index = self._index
+        if index is not None and index.root is self:
+            return index
+        if self._frozen:
+            index = self._index = _TreeIndex(self, False)
+        elif self._up is None:
+            index = self._index = _TreeIndex(self, True)
+        else:
+            # a node inside a Tree, its changes only reach the index of the
+            # Tree, so it is indexed for this call
+            index = _TreeIndex(self, False)
+        return index
 
     def setVariable(self, key, value, flattend=True):
         """
         set variable item
         """
-        for path in self:
-            for item in path:
+        index = self._trees()
+        if index.shared:
+            holds = lambda tree: tree._holdsVariable(key, flattend)
+            for node in self._own(holds):
+                item = node.value
                 if isinstance(item, Tree.Variable):
                     if item.name == key:
-                        item.value = value
-                if isinstance(item, Tree) and flattend:
+                        item._setvalue(value)
+                if flattend and isinstance(item, Tree) and item._trees().branches():
                     item.setVariable(key, value, flattend)
+            return
+        for node in index.carriers(key, flattend):
+            item = node.value
+            if isinstance(item, Tree.Variable):
+                if item.name == key:
+                    item._setvalue(value)
+            if flattend and item._trees().branches():
+                item.setVariable(key, value, flattend)
+
+    def _holdsVariable(self, key, flattend):
+        """
+        False if self does not hold variable key
+        """
+        index = self._trees()
+        if isinstance(self, Tree.Variable) and self.name == key:
+            return True
+        return bool(index.regions or index.carriers(key, flattend))
+
+    def _own(self, holds):
+        """
+        yield the nodes from self on in path order, frozen (shared) nodes
+        and frozen Tree values are replaced by changeable copies first,
+        unless holds(tree) tells they do not hold what is changed
+        """
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node.value, Tree) and node.value._frozen:
+                if holds(node.value):
+                    node._setvalue(node.value.copy())
+            if _instrumenting:
+                _count("nodes", 1)
+            yield node
+            for attr in ("_lower_node", "_next_node"):
+                child = getattr(node, attr)
+                if child is not None and (not child._frozen or holds(child)):
+                    nodes.append(node._ownlink(attr))
         
     def getVariable(self, key, flattend=True):
         """
         get variable item
         """
-        for path in self:
-            for item in path:
-                if isinstance(item, Tree.Variable):
-                    if item.name == key:
-                        return item.value
-                if isinstance(item, Tree) and flattend:
-                    n = item.getVariable(key, flattend)
-                    if n: return n;
+        return self._findVariable(key, flattend)[1]
+
+    def _findVariable(self, key, flattend):
+        """
+        returns (True, value) of the first variable key, or (False, None)
+        """
+        index = self._trees()
+        nodes = None if index.regions else index.carriers(key, flattend)
+        # the first of more nodes in path order is found by walking
+        if nodes is None or len(nodes) > 1:
+            visited = 0
+            routes = [self]
+            try:
+                while routes:
+                    node = routes.pop()
+                    visited += 1
+                    if node._frozen and not self._frozen:
+                        # shared nodes, from here on they have their own index
+                        found = node._findVariable(key, flattend)
+                        if found[0]:
+                            return found
+                        continue
+                    item = node.value
+                    if isinstance(item, Tree.Variable):
+                        if item.name == key:
+                            return True, item.value
+                    if isinstance(item, Tree) and flattend:
+                        n = item.getVariable(key, flattend)
+                        if n: return True, n;
+                    for child in (node._lower_node, node._next_node):
+                        if child is not None:
+                            routes.append(child)
+                return False, None
+            finally:
+                if _instrumenting:
+                    _count("nodes", visited)
+        for node in nodes:
+            item = node.value
+            if isinstance(item, Tree.Variable) and item.name == key:
+                return True, item.value
+            if flattend:
+                n = item.getVariable(key, flattend)
+                if n: return True, n;
+        return False, None
 
     def flush(self, key, flattend=True):
         """
@@ -747,6 +3195,34 @@ class Tree():
         var = getVariable(key, flattend)
         setVariable(var.name, var.value, flattend)
 
+    def stats(self):
+        """
+        returns a summary of self: the nodes holding a value, nested Trees
+        included (nodes), the most values on one path (depth), the number
+        of variables and the bytes of the str values
+        """
+        nodes = variables = size = depth = 0
+        stack = [(self, 1)]
+        while stack:
+            node, level = stack.pop()
+            if node is None:
+                continue
+            value = node.value
+            if value is not None:
+                nodes += 1
+                depth = max(depth, level)
+            if isinstance(value, Tree):
+                if isinstance(value, Tree.Variable):
+                    variables += 1
+                # the paths of a nested Tree continue the path holding it
+                stack.append((value, level))
+            elif isinstance(value, str):
+                size += len(value.encode("utf-8", "surrogatepass"))
+            stack.append((node._lower_node, level))
+            stack.append((node._next_node, level + 1))
+        return {"nodes": nodes, "depth": depth, "variables": variables,
+                "bytes": size}
+
     def toList(self, flattend=True):
         """
         convert to patlang List (of patlang List) ..
@@ -757,7 +3233,7 @@ class Tree():
             return List.Variable(self.name, self.value)
             
         returnlist = List()
-        for path in self:
+        for path in self.iter_paths():
             pathlist = List()
             for item in path:
                 if isinstance(item, Tree) and flattend:
@@ -771,19 +3247,37 @@ class Tree():
         else:
             return list.__getitem__(returnlist, 0)
 
-    def toString(self, flattend=True):
+    def _group(self, flattend):
+        """
+        returns self as the _Group that toList(flattend) would return
+        """
+        if isinstance(self, Tree.Variable) and flattend:
+            return _Group(self.name, (self.value,))
+        paths = list(self.iter_paths())
+        if len(paths) > 1:
+            return _Group(None, [_Group(None, path) for path in paths])
+        return _Group(None, paths[0])
+
+    def toString(self, flattend=True, sep="", endline=""):
         """
         convert to patlang String
-        """ 
-        L = self.toList(flattend)
-        return L.toString(flattend)
-    
+        """
+        def expand(item):
+            if isinstance(item, Tree) and flattend:
+                return item._group(flattend)
+
+        return _joinString(self._group(flattend), expand, sep, endline)
+
 class VariableTree(Tree):
     """
     a Variable is a Pattern with a name
     """
+
+    __slots__ = ("name",)
     
-    def __init__(self, name = "", value = Tree(), *args):
+    def __init__(self, name = "", value = None, *args):
+        if value is None:
+            value = Tree()
         super().__init__(value, *args)
         self.name = name
 
@@ -791,8 +3285,1068 @@ class VariableTree(Tree):
         return repr(self.name) + ":" + repr(self.value)
     
     def copy(self):
+        if self._frozen:
+            return self._clone()
         newVariable = Tree.Variable(self.name)
         return self._copy(newVariable)
 
 # propper alias
 Tree.Variable = VariableTree
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Batch rendering                                                              #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+def _renderer(template):
+    """
+    returns a function rendering template with one set of bindings
+    """
+    if isinstance(template, List):
+        template = template.compile()
+    if isinstance(template, CompiledList):
+        return template.render
+
+    if isinstance(template, String):
+        def render(bindings):
+            pat = String(str.__str__(template))
+            pat.variables = _Variables(template.variables)
+            if hasattr(bindings, "items"):
+                bindings = bindings.items()
+            for key, value in bindings:
+                pat[key] = value
+            return str(pat)
+        return render
+
+    def render(bindings):
+        pat = template.copy()
+        if hasattr(bindings, "items"):
+            bindings = bindings.items()
+        for key, value in bindings:
+            pat.setVariable(key, value)
+        return str(pat)
+    return render
+
+def _render_chunk(render, chunk):
+    """
+    render a chunk of (path, bindings), returns the rendered strings or the
+    paths written
+    """
+    results = []
+    for path, bindings in chunk:
+        out = render(bindings)
+        if path is None:
+            results.append(out)
+        else:
+            with open(path, "w") as f:
+                f.write(out)
+            results.append(path)
+    return results
+
+# renderer of the template in a worker process, set once per worker
+_worker_render = None
+
+def _init_worker(template):
+    global _worker_render
+    _worker_render = _renderer(template)
+
+def _render_worker(chunk):
+    return _render_chunk(_worker_render, chunk)
+
+def render_batch(template, bindings, paths=None, workers=None, chunksize=64,
+                 ordered=True):
+    """
+    render template (String, List, CompiledList or Tree) for each set of
+    bindings, as if each binding was set on a copy of template, spread over
+    worker processes
+
+    If paths is given, each rendering is written to the matching path and
+    the path is yielded instead of the rendered string. Results are yielded
+    in the order of bindings, or as they finish if ordered is False. The
+    template is sent to each worker once, bindings are sent in chunks of
+    chunksize. With workers <= 1, or when no process pool can be used,
+    rendering is done in this process.
+    """
+    render = _renderer(template)
+    if paths is None:
+        items = ((None, b) for b in bindings)
+    else:
+        items = zip(paths, bindings)
+
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for chunk in chunks():
+            yield from _render_chunk(render, chunk)
+        return
+
+    try:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(template,))
+    except (OSError, NotImplementedError, ImportError):
+        for chunk in chunks():
+            yield from _render_chunk(render, chunk)
+        return
+
+    def finish(pending):
+        """
+        yield the results of the next finished (or first if ordered) chunk
+        """
+        if ordered:
+            future, chunk = pending.popleft()
+        else:
+            futures = [f for f, _ in pending if f is not None]
+            if len(futures) < len(pending):
+                # first render a chunk the pool did not take
+                i = next(i for i, (f, _) in enumerate(pending) if f is None)
+            else:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                i = next(i for i, (f, _) in enumerate(pending) if f in done)
+            future, chunk = pending[i]
+            del pending[i]
+        if future is not None:
+            # a chunk that could not be rendered by a worker (not picklable,
+            # broken pool) is rendered here, errors of render reappear here
+            try:
+                yield from future.result()
+                return
+            except Exception:
+                pass
+        yield from _render_chunk(render, chunk)
+
+    with executor:
+        pending = collections.deque()
+        for chunk in chunks():
+            try:
+                future = executor.submit(_render_worker, chunk)
+            except RuntimeError:
+                # the pool is broken or shut down
+                future = None
+            pending.append((future, chunk))
+
+            # limit the chunks in flight, so bindings are consumed lazily
+            while len(pending) >= 2 * workers:
+                yield from finish(pending)
+
+        while pending:
+            yield from finish(pending)
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Serialization                                                                #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+# magic, version, offset of the string table and offset of the root record
+_HEADER = struct.Struct("<4sHxxQQ")
+_MAGIC = b"PATL"
+_VERSION = 1
+
+# tags of the records, _LISTS is a plain list of patterns, as
+# String.toList returns for more than one line
+(_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _BYTES, _STRING, _LIST,
+ _LISTVARIABLE, _TREE, _REF, _PATTERNS, _LISTS) = range(14)
+
+# flags of a List record
+_INDEXVARIABLES, _INDEXITEMS = 1, 2
+
+# flags of a node in a Tree record
+_VARIABLENODE, _NEXTNODE, _LOWERNODE, _FROZENNODE = 1, 2, 4, 8
+
+_FLOAT64 = struct.Struct("<d")
+_OFFSET = struct.Struct("<Q")
+
+class _Writer():
+    """
+    encodes patterns as records, each str is written once to a string table
+    and records refer to it by index
+
+    Numbers are written as (zigzag) varints, a Tree is written node by node
+    in path order with flags for the links that follow, a frozen Tree that
+    was written before is written as a reference to its record.
+    """
+
+    def __init__(self):
+        self.out = bytearray(_HEADER.size)
+        self.strings = dict()
+        self.refs = dict()
+
+    def uint(self, n):
+        out = self.out
+        while n > 0x7f:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def string(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        self.uint(index)
+
+    def record(self, value):
+        out = self.out
+        if value is None:
+            out.append(_NONE)
+        elif value is False or value is True:
+            out.append(_TRUE if value else _FALSE)
+        elif isinstance(value, int):
+            out.append(_INT)
+            self.uint(value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _FLOAT64.pack(value)
+        elif isinstance(value, String):
+            out.append(_STRING)
+            self.string(str.__str__(value))
+            self.uint(len(value.variables))
+            for key, item in value.variables.items():
+                self.record(key)
+                self.record(item)
+        elif isinstance(value, str):
+            out.append(_STR)
+            self.string(str.__str__(value))
+        elif isinstance(value, bytes):
+            out.append(_BYTES)
+            self.uint(len(value))
+            out += value
+        elif type(value) in (List, List.Variable):
+            self.list(value)
+        elif type(value) is list:
+            out.append(_LISTS)
+            self.uint(len(value))
+            for item in value:
+                self.record(item)
+        elif isinstance(value, Tree):
+            self.tree(value)
+        else:
+            raise TypeError("cannot dump %r" % type(value).__name__)
+
+    def list(self, value):
+        out = self.out
+        if isinstance(value, List.Variable):
+            out.append(_LISTVARIABLE)
+            self.record(value.name)
+        else:
+            out.append(_LIST)
+        flags = 0
+        if value._index is not None:
+            if value._index.names is not None:
+                flags |= _INDEXVARIABLES
+            if value._index.items is not None:
+                flags |= _INDEXITEMS
+        out.append(flags)
+        self.uint(len(value))
+        for item in list.__iter__(value):
+            self.record(item)
+
+    def tree(self, value):
+        out = self.out
+        if value._frozen:
+            offset = self.refs.get(id(value))
+            if offset is not None:
+                out.append(_REF)
+                self.uint(offset)
+                return
+            self.refs[id(value)] = len(out)
+        out.append(_TREE)
+        nodes = [value]
+        while nodes:
+            node = nodes.pop()
+            flags = 0
+            if isinstance(node, Tree.Variable):
+                flags |= _VARIABLENODE
+            if node._next_node is not None:
+                flags |= _NEXTNODE
+            if node._lower_node is not None:
+                flags |= _LOWERNODE
+            if node._frozen:
+                flags |= _FROZENNODE
+            out.append(flags)
+            if flags & _VARIABLENODE:
+                self.record(node.name)
+            self.record(node.value)
+            if node._lower_node is not None:
+                nodes.append(node._lower_node)
+            if node._next_node is not None:
+                nodes.append(node._next_node)
+
+    def patterns(self, patterns):
+        """
+        write each pattern of the mapping patterns, followed by the index of
+        their names and offsets, returns the offset of the index
+        """
+        offsets = []
+        for name, pattern in patterns.items():
+            if not isinstance(name, str):
+                raise TypeError("pattern names must be str, not %r"
+                                % type(name).__name__)
+            offsets.append((name, len(self.out)))
+            self.record(pattern)
+        root = len(self.out)
+        self.out.append(_PATTERNS)
+        self.uint(len(offsets))
+        for name, offset in offsets:
+            self.string(name)
+            self.out += _OFFSET.pack(offset)
+        return root
+
+    def finish(self, root):
+        """
+        append the string table and fill in the header, returns the bytes
+        """
+        out = self.out
+        table = len(out)
+        blobs = [value.encode("utf-8", "surrogatepass")
+                 for value in self.strings]
+        out += struct.pack("<I", len(blobs))
+        offset = 0
+        out += _OFFSET.pack(offset)
+        for blob in blobs:
+            offset += len(blob)
+            out += _OFFSET.pack(offset)
+        out += b"".join(blobs)
+        _HEADER.pack_into(out, 0, _MAGIC, _VERSION, table, root)
+        return out
+
+class _Reader():
+    """
+    decodes records from the (memory mapped) data of a dump, strings are
+    decoded from the string table when a record first refers to them
+    """
+
+    def __init__(self, data):
+        if len(data) < _HEADER.size:
+            raise ValueError("not a patlang dump")
+        magic, version, table, root = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("not a patlang dump")
+        if version > _VERSION:
+            raise ValueError("unsupported patlang dump version %d" % version)
+        self.data = data
+        self.root = root
+        count, = struct.unpack_from("<I", data, table)
+        self.table = table + 4
+        self.blobs = self.table + _OFFSET.size * (count + 1)
+        self.strings = [None] * count
+        self.refs = dict()
+
+    def uint(self, pos):
+        data = self.data
+        n = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n, pos
+            shift += 7
+
+    def string(self, pos):
+        index = self.data[pos]
+        if index < 0x80:
+            pos += 1
+        else:
+            index, pos = self.uint(pos)
+        value = self.strings[index]
+        if value is None:
+            start, end = struct.unpack_from("<QQ", self.data,
+                                            self.table + _OFFSET.size * index)
+            value = str(self.data[self.blobs + start:self.blobs + end],
+                        "utf-8", "surrogatepass")
+            self.strings[index] = value
+        return value, pos
+
+    def record(self, pos):
+        """
+        returns the value of the record at pos and the position after it
+        """
+        data = self.data
+        tag = data[pos]
+        pos += 1
+        if tag == _STR:
+            return self.string(pos)
+        if tag == _NONE:
+            return None, pos
+        if tag == _FALSE or tag == _TRUE:
+            return tag == _TRUE, pos
+        if tag == _INT:
+            n, pos = self.uint(pos)
+            return (-((n + 1) >> 1) if n & 1 else n >> 1), pos
+        if tag == _FLOAT:
+            return _FLOAT64.unpack_from(data, pos)[0], pos + _FLOAT64.size
+        if tag == _BYTES:
+            size, pos = self.uint(pos)
+            return bytes(data[pos:pos + size]), pos + size
+        if tag == _STRING:
+            text, pos = self.string(pos)
+            count, pos = self.uint(pos)
+            variables = _Variables()
+            for _ in range(count):
+                key, pos = self.record(pos)
+                variables[key], pos = self.record(pos)
+            S = String(text)
+            S.variables = variables
+            return S, pos
+        if tag == _LIST or tag == _LISTVARIABLE:
+            return self.list(tag, pos)
+        if tag == _LISTS:
+            count, pos = self.uint(pos)
+            items = []
+            for _ in range(count):
+                item, pos = self.record(pos)
+                items.append(item)
+            return items, pos
+        if tag == _TREE:
+            return self.tree(pos)
+        if tag == _REF:
+            offset, pos = self.uint(pos)
+            value = self.refs.get(offset)
+            if value is None:
+                value, _ = self.record(offset)
+            return value, pos
+        raise ValueError("invalid patlang dump, unknown record %d" % tag)
+
+    def list(self, tag, pos):
+        if tag == _LISTVARIABLE:
+            name, pos = self.record(pos)
+        flags = self.data[pos]
+        count, pos = self.uint(pos + 1)
+        items = []
+        for _ in range(count):
+            item, pos = self.record(pos)
+            items.append(item)
+        if tag == _LISTVARIABLE:
+            L = List.Variable(name, *items)
+        else:
+            L = List(*items)
+        if flags:
+            L._enableIndex(bool(flags & _INDEXVARIABLES),
+                           bool(flags & _INDEXITEMS))
+        return L, pos
+
+    def tree(self, pos):
+        data = self.data
+        start = pos - 1
+        root = None
+        links = []
+        while True:
+            flags = data[pos]
+            pos += 1
+            if flags & _VARIABLENODE:
+                node = Tree.__new__(Tree.Variable)
+                node.name, pos = self.record(pos)
+            else:
+                node = Tree.__new__(Tree)
+            if data[pos] == _STR:
+                value, pos = self.string(pos + 1)
+                node.value = sys.intern(value)
+            else:
+                value, pos = self.record(pos)
+                node.value = _intern(value)
+            node._lower_node = node._next_node = None
+            node._siblings = node._up = node._hash = node._index = None
+            node._frozen = bool(flags & _FROZENNODE)
+            if links:
+                above, attr = links.pop()
+                setattr(above, attr, node)
+                node._up = above
+            else:
+                root = node
+            if flags & _LOWERNODE:
+                links.append((node, "_lower_node"))
+            if flags & _NEXTNODE:
+                links.append((node, "_next_node"))
+            if not links:
+                break
+        if root._frozen:
+            self.refs[start] = root
+        return root, pos
+
+class _Patterns(collections.abc.Mapping):
+    """
+    read-only mapping of the patterns in a dump, each pattern is decoded
+    from the (memory mapped) dump when it is looked up, as a new pattern
+    """
+
+    def __init__(self, reader, pos, close):
+        self._reader = reader
+        self._close = close
+        count, pos = reader.uint(pos)
+        self._offsets = dict()
+        for _ in range(count):
+            name, pos = reader.string(pos)
+            self._offsets[name] = _OFFSET.unpack_from(reader.data, pos)[0]
+            pos += _OFFSET.size
+
+    def __getitem__(self, name):
+        if self._reader is None:
+            raise ValueError("patterns of a closed dump")
+        return self._reader.record(self._offsets[name])[0]
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def close(self):
+        """
+        release the (memory mapped) dump
+        """
+        self._reader = None
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def dump(pattern, file):
+    """
+    write pattern (String, List or Tree, or a list of them as toList returns
+    for more lines) or a mapping of names to patterns to file (a path or a binary file) in the patlang binary format
+    """
+    writer = _Writer()
+    if isinstance(pattern, collections.abc.Mapping):
+        root = writer.patterns(pattern)
+    else:
+        root = len(writer.out)
+        writer.record(pattern)
+    data = writer.finish(root)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            f.write(data)
+    else:
+        file.write(data)
+
+def load(file):
+    """
+    returns the pattern dumped to file (a path, a binary file or bytes), or
+    for a dumped mapping a read-only mapping of its patterns
+
+    Files are memory mapped, the patterns of a mapping are only decoded
+    when they are looked up, so only the patterns used are read. The mapping
+    keeps the file mapped until it is closed (or used as context manager).
+    """
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        data, close = file, None
+    else:
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "rb") as f:
+                data, close = _mapped(f)
+        else:
+            data, close = _mapped(file)
+    reader = _Reader(data)
+    if data[reader.root] == _PATTERNS:
+        return _Patterns(reader, reader.root + 1, close)
+    try:
+        return reader.record(reader.root)[0]
+    finally:
+        if close is not None:
+            close()
+
+def _mapped(f):
+    """
+    returns the content of binary file f memory mapped and the function
+    releasing it, or read into bytes if it cannot be mapped
+    """
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return f.read(), None
+    return data, data.close
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Template cache                                                               #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+class TemplateCache():
+    """
+    a directory of converted templates, like __pycache__, each conversion is
+    stored as a dump keyed by a hash of the template (its text and
+    variables) and the conversion options
+
+    Entries are written to a temporary file and renamed into place, so
+    processes sharing the directory never read a partial entry. A hit
+    touches the entry, after a write the least recently used entries are
+    removed until the directory holds at most maxsize bytes.
+    """
+
+    def __init__(self, directory="__patcache__", maxsize=256 * 2**20):
+        self.directory = os.fspath(directory)
+        self.maxsize = maxsize
+        os.makedirs(self.directory, exist_ok=True)
+
+    def toList(self, pattern, flattend=True, sep="", endline=""):
+        """
+        returns pattern (a String or str) converted to patlang List, loaded
+        from the cache if it was converted before
+        """
+        pattern = String(pattern) if type(pattern) is str else pattern
+        return self._cached(
+            pattern, ("toList", flattend, sep, endline),
+            lambda: pattern.toList(flattend, sep, endline))
+
+    def toTree(self, pattern, flattend=True):
+        """
+        returns pattern (a String or str) converted to patlang Tree, loaded
+        from the cache if it was converted before
+        """
+        pattern = String(pattern) if type(pattern) is str else pattern
+        return self._cached(pattern, ("toTree", flattend),
+                            lambda: pattern.toTree(flattend))
+
+    def compile(self, pattern, flattend=True, sep="", endline=""):
+        """
+        returns pattern (a String or str) as CompiledList, of the List
+        loaded from the cache if it was converted before
+        """
+        return CompiledList(self.toList(pattern, flattend, sep, endline))
+
+    def _key(self, pattern, options):
+        """
+        returns the hex digest of the dump of pattern and the options
+        """
+        data = io.BytesIO()
+        dump(pattern, data)
+        digest = hashlib.sha256(data.getvalue())
+        digest.update(repr((_VERSION,) + options).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _cached(self, pattern, options, convert):
+        try:
+            key = self._key(pattern, options)
+        except TypeError:
+            # variables that cannot be dumped, nothing to cache
+            return convert()
+        path = os.path.join(self.directory, key + ".patl")
+        try:
+            converted = load(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, IndexError, struct.error):
+            # unreadable entry, from an other version or a damaged file
+            self._remove(path)
+        else:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return converted
+
+        converted = convert()
+        self._write(path, converted)
+        self._evict()
+        return converted
+
+    def _write(self, path, converted):
+        """
+        write the entry to a temporary file and rename it to path
+        """
+        try:
+            fd, temp = tempfile.mkstemp(dir=self.directory, prefix=".",
+                                        suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                dump(converted, f)
+            os.replace(temp, path)
+        except (OSError, TypeError):
+            self._remove(temp)
+        except BaseException:
+            self._remove(temp)
+            raise
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """
+        remove the least recently used entries until the cache fits maxsize
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".patl"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.maxsize:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        """
+        remove all entries
+        """
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".patl"):
+                    self._remove(entry.path)
+
+#------------------------------------------------------------------------------#
+#                                                                              #
+# Instrumentation                                                              #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+# True while any instrument() is active, checked by the walks counting nodes
+_instrumenting = False
+
+# the running operation of each thread, see _Operation
+_thread = threading.local()
+
+# counters of an operation, depth and seconds are not summed but maximized
+# and measured
+_COUNTERS = ("calls", "seconds", "nodes", "depth", "passes", "substitutions",
+             "copies", "allocations")
+
+class _Operation():
+    """
+    counters of the outermost public operation running in a thread, nested
+    public operations (recursion included) count for it
+    """
+
+    __slots__ = _COUNTERS + ("level",)
+
+    def __init__(self):
+        for counter in _COUNTERS:
+            setattr(self, counter, 0)
+        self.calls = self.level = self.depth = 1
+
+def _count(counter, n):
+    """
+    add n to counter of the operation running in this thread
+    """
+    operation = getattr(_thread, "operation", None)
+    if operation is not None:
+        setattr(operation, counter, getattr(operation, counter) + n)
+
+class _Stats():
+    """
+    counters per public operation ("Tree.getVariable", ...), of the
+    operations run while instrumenting
+
+    calls and seconds count the outermost calls. nodes counts the Tree
+    nodes walked and the items of the Lists visited, depth is the deepest
+    nesting of public operations (recursion), passes and substitutions the
+    passes over the text and the replacements made rendering or splitting a
+    String, copies the calls of copy and allocations the patterns and
+    nodes created.
+    """
+
+    def __init__(self):
+        self.operations = dict()
+
+    def __enter__(self):
+        _instrument(self)
+        return self
+
+    def __exit__(self, *exc):
+        _uninstrument(self)
+
+    def __getitem__(self, name):
+        return self.operations[name]
+
+    def _add(self, name, operation):
+        counters = self.operations.get(name)
+        if counters is None:
+            counters = self.operations[name] = dict.fromkeys(_COUNTERS, 0)
+        for counter in _COUNTERS:
+            if counter == "depth":
+                counters[counter] = max(counters[counter], operation.depth)
+            else:
+                counters[counter] += getattr(operation, counter)
+
+    def report(self):
+        """
+        returns the counters as a table, slowest operations first
+        """
+        lines = ["%-24s" % "operation" + "".join("%14s" % counter
+                                                   for counter in _COUNTERS)]
+        for name, counters in sorted(self.operations.items(),
+                                     key=lambda item: -item[1]["seconds"]):
+            lines.append("%-24s" % name + "".join(
+                "%14.6f" % counters[counter] if counter == "seconds"
+                else "%14d" % counters[counter] for counter in _COUNTERS))
+        return "\n".join(lines)
+
+def instrument():
+    """
+    returns a context manager counting and timing the public operations of
+    String, List, Tree and CompiledList while it is active
+
+    Instrumentation replaces the methods by counting ones when it starts and
+    restores them when the last instrument() ends, the methods run as they
+    are otherwise.
+    """
+    return _Stats()
+
+def _timed(name, function, counter=None):
+    """
+    returns function timed as the public operation name, counter is counted
+    once for each call
+    """
+    def timed(*args, **kwargs):
+        operation = getattr(_thread, "operation", None)
+        if operation is not None:
+            # nested in an other public operation
+            operation.level += 1
+            operation.depth = max(operation.depth, operation.level)
+            if counter is not None:
+                setattr(operation, counter, getattr(operation, counter) + 1)
+            if args and isinstance(args[0], List):
+                operation.nodes += list.__len__(args[0])
+            try:
+                return function(*args, **kwargs)
+            finally:
+                operation.level -= 1
+
+        operation = _thread.operation = _Operation()
+        if counter is not None:
+            setattr(operation, counter, 1)
+        if args and isinstance(args[0], List):
+            operation.nodes += list.__len__(args[0])
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            operation.seconds = time.perf_counter() - start
+            _thread.operation = None
+            for stats in list(_collectors):
+                stats._add(name, operation)
+    return timed
+
+def _timedIter(name, function):
+    """
+    returns generator function timed as the public operation name across
+    its iteration, the time the consumer takes between items is left out
+    """
+    def timed(*args, **kwargs):
+        iterator = function(*args, **kwargs)
+        operation = _Operation()
+        try:
+            while True:
+                outer = getattr(_thread, "operation", None)
+                if outer is not None:
+                    # resumed in an other public operation, counts for it
+                    outer.level += 1
+                    outer.depth = max(outer.depth, outer.level)
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        outer.level -= 1
+                else:
+                    _thread.operation = operation
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        operation.seconds += time.perf_counter() - start
+                        _thread.operation = None
+                yield item
+        finally:
+            iterator.close()
+            if operation.seconds:
+                for stats in list(_collectors):
+                    stats._add(name, operation)
+    return timed
+
+def _counted(function, counter):
+    """
+    returns function counting counter once for each call
+    """
+    def counted(*args, **kwargs):
+        operation = getattr(_thread, "operation", None)
+        if operation is not None:
+            setattr(operation, counter, getattr(operation, counter) + 1)
+        return function(*args, **kwargs)
+    return counted
+
+def _countedApply(apply):
+    """
+    returns _Substitution.apply counting its passes and substitutions
+    """
+    def counted(self, text):
+        operation = getattr(_thread, "operation", None)
+        if operation is not None:
+            operation.passes += len(self.stages)
+            for target, replacement in self.stages:
+                # counted on the text the stage is applied to
+                if isinstance(target, str):
+                    operation.substitutions += text.count(target)
+                    text = text.replace(target, replacement)
+                else:
+                    parts = target.split(text)
+                    operation.substitutions += len(parts) // 2
+                    parts[1::2] = [replacement[key] for key in parts[1::2]]
+                    text = "".join(parts)
+            return text
+        return apply(self, text)
+    return counted
+
+def _countedTokens(tokens):
+    """
+    returns _Tokenizer.tokens counting its passes and the keys it split on
+    """
+    def counted(self, text):
+        result = tokens(self, text)
+        operation = getattr(_thread, "operation", None)
+        if operation is not None:
+            operation.passes += len(self.stages)
+            operation.substitutions += sum(1 for _, key in result
+                                           if key is not None)
+        return result
+    return counted
+
+def _countedWalk(walk):
+    """
+    returns List._walk counting the items it yields as nodes
+    """
+    def counted(parent, items):
+        for pair in walk(parent, items):
+            _count("nodes", 1)
+            yield pair
+    return counted
+
+# (class, method, public operation name or counter, how to wrap it)
+_INSTRUMENTED = [
+    (String, "__new__", "allocations", _counted),
+    (String, "__str__", "String.__str__", _timed),
+    (String, "__repr__", "String.__repr__", _timed),
+    (String, "__contains__", "String.__contains__", _timed),
+    (String, "flush", "String.flush", _timed),
+    (String, "toList", "String.toList", _timed),
+    (String, "toTree", "String.toTree", _timed),
+    (StringBuilder, "build", "String.Builder.build", _timed),
+    (List, "__init__", "allocations", _counted),
+    (List.Variable, "__init__", "allocations", _counted),
+    (List, "__str__", "List.__str__", _timed),
+    (List, "__repr__", "List.__repr__", _timed),
+    (List, "__getitem__", "List.__getitem__", _timed),
+    (List, "__setitem__", "List.__setitem__", _timed),
+    (List, "__contains__", "List.__contains__", _timed),
+    (List, "getItem", "List.getItem", _timed),
+    (List, "_getItem", "List.getItem", _timed),
+    (List, "setItem", "List.setItem", _timed),
+    (List, "getVariable", "List.getVariable", _timed),
+    (List, "_getVariable", "List.getVariable", _timed),
+    (List, "setVariable", "List.setVariable", _timed),
+    (List, "copy", "List.copy", _timed),
+    (List, "toString", "List.toString", _timed),
+    (List, "toTree", "List.toTree", _timed),
+    (List, "compile", "List.compile", _timed),
+    (List.Variable, "copy", "List.copy", _timed),
+    (CompiledList, "render", "CompiledList.render", _timed),
+    (CompiledList, "render_many", "CompiledList.render_many", _timedIter),
+    (Tree, "__init__", "allocations", _counted),
+    (Tree.Variable, "__init__", "allocations", _counted),
+    (Tree, "_leaf", "allocations", _counted),
+    (Tree, "_clone", "allocations", _counted),
+    (Tree, "__getitem__", "Tree.__getitem__", _timed),
+    (Tree, "__setitem__", "Tree.__setitem__", _timed),
+    (Tree, "__contains__", "Tree.__contains__", _timed),
+    (Tree, "__eq__", "Tree.__eq__", _timed),
+    (Tree, "__str__", "Tree.__str__", _timed),
+    (Tree, "__repr__", "Tree.__repr__", _timed),
+    (Tree, "getItem", "Tree.getItem", _timed),
+    (Tree, "setItem", "Tree.setItem", _timed),
+    (Tree, "getVariable", "Tree.getVariable", _timed),
+    (Tree, "setVariable", "Tree.setVariable", _timed),
+    (Tree, "remove", "Tree.remove", _timed),
+    (Tree, "copy", "Tree.copy", _timed),
+    (Tree, "freeze", "Tree.freeze", _timed),
+    (Tree, "from_paths", "Tree.from_paths", _timed),
+    (Tree, "toList", "Tree.toList", _timed),
+    (Tree, "toString", "Tree.toString", _timed),
+    (Tree.Variable, "__repr__", "Tree.__repr__", _timed),
+    (Tree.Variable, "copy", "Tree.copy", _timed),
+]
+
+# the active _Stats and the methods replaced while there are any
+_collectors = []
+_replaced = []
+
+def _instrument(stats):
+    global _instrumenting
+    _collectors.append(stats)
+    if _replaced:
+        return
+    hooks = [(_Substitution, "apply", _countedApply),
+             (_Tokenizer, "tokens", _countedTokens),
+             (List, "_walk", _countedWalk)]
+    for cls, name, wrap in hooks:
+        _replace(cls, name, lambda function, wrap=wrap: wrap(function))
+    for cls, name, label, wrap in _INSTRUMENTED:
+        if wrap is _counted:
+            make = lambda function, label=label: _counted(function, label)
+        elif wrap is _timedIter:
+            make = lambda function, label=label: _timedIter(label, function)
+        elif name.endswith("copy"):
+            make = lambda function, label=label: _timed(label, function,
+                                                        "copies")
+        else:
+            make = lambda function, label=label: _timed(label, function)
+        _replace(cls, name, make)
+    _instrumenting = True
+
+def _replace(cls, name, make):
+    """
+    replace method name of cls by make(method), keeping it static or a
+    classmethod if it was
+    """
+    original = cls.__dict__[name]
+    if isinstance(original, (staticmethod, classmethod)):
+        replacement = type(original)(make(original.__func__))
+    else:
+        replacement = make(original)
+    _replaced.append((cls, name, original))
+    setattr(cls, name, replacement)
+
+def _uninstrument(stats):
+    global _instrumenting
+    _collectors.remove(stats)
+    if _collectors:
+        return
+    _instrumenting = False
+    while _replaced:
+        cls, name, original = _replaced.pop()
+        setattr(cls, name, original)
@@ -0,0 +1,128 @@
+"""
+Tree.from_paths against merging the paths one by one
+"""
+
+import random
+import unittest
+
+from patlang import Tree
+
+
+def merged(paths):
+    """
+    returns a Tree of paths merged one by one
+    """
+    tree = Tree()
+    for path in paths:
+        node = tree
+        for value in path:
+            node = node[value]
+    return tree
+
+
+def setmerged(paths):
+    """
+    returns a Tree of paths merged one by one with _setmerge
+    """
+    tree = Tree()
+    for path in paths:
+        tree._setmerge(*path)
+    return tree
+
+
+class TestFromPaths(unittest.TestCase):
+
+    def assertSamePaths(self, paths):
+        result = Tree.from_paths(paths, sort=True)
+        expected = merged(paths)
+        self.assertEqual(sorted(map(repr, result.iter_paths())),
+                         sorted(map(repr, expected.iter_paths())))
+
+    def test_strings(self):
+        self.assertSamePaths([["b", "c"], ["a"], ["b", "a"], ["a", "c"]])
+
+    def test_variables(self):
+        # variables are sorted by name, next to each other
+        self.assertSamePaths([
+            [Tree.Variable("name", "x"), "a"],
+            ["a", Tree.Variable("name", "x")],
+            [Tree.Variable("other"), "b"],
+            [Tree.Variable("name", "x"), "b"],
+            ["a", Tree.Variable("other")],
+        ])
+        tree = Tree.from_paths([[Tree.Variable("b"), "x"],
+                                [Tree.Variable("a"), "y"],
+                                [Tree.Variable("b"), "z"]], sort=True)
+        self.assertEqual([path[0].name for path in tree.iter_paths()],
+                         ["a", "b", "b"])
+
+    def test_variable_names(self):
+        self.assertSamePaths([[Tree.Variable(1), "a"],
+                              [Tree.Variable("1"), "b"],
+                              [Tree.Variable(1), "c"]])
+
+    def test_mixed_types(self):
+        self.assertSamePaths([[1, "a"], ["1", "b"], [2.5], [b"x"], [1, "c"],
+                              [Tree.Variable("v"), 2], ["1", 1]])
+
+    def test_unordered_values(self):
+        # nested Trees have no order, the paths are merged as they are
+        nested = Tree.from_paths([["n"]])
+        self.assertSamePaths([["a", nested], [nested], ["a", "b"]])
+        self.assertSamePaths([[float("nan")], ["a"], [None, "b"]])
+
+    def test_random(self):
+        rng = random.Random(18)
+        values = ["a", "b", 1, 2, 2.5, b"x", Tree.Variable("x"),
+                  Tree.Variable("y", "v"), Tree.Variable(1)]
+        for _ in range(500):
+            paths = [[rng.choice(values) for _ in range(rng.randint(1, 3))]
+                     for _ in range(rng.randint(0, 6))]
+            with self.subTest(paths=paths):
+                self.assertSamePaths(paths)
+
+
+class TestFromPathsUnsorted(unittest.TestCase):
+
+    def assertSameTree(self, paths):
+        result = Tree.from_paths(paths)
+        expected = setmerged(paths)
+        self.assertEqual(result, expected)
+        self.assertEqual(repr(result), repr(expected))
+        self.assertEqual(Tree.from_paths(iter(paths)), expected)
+
+    def test_strings(self):
+        self.assertSameTree([["b", "c"], ["a"], ["b", "a"], ["a", "c"],
+                             ["b", "c", "d"]])
+
+    def test_variables(self):
+        self.assertSameTree([
+            [Tree.Variable("name", "x"), "a"],
+            ["a", Tree.Variable("name", "x")],
+            [Tree.Variable("other"), "b"],
+            [Tree.Variable("name", "y"), "b"],
+            ["a", Tree.Variable("other")],
+            [Tree.Variable(1), "c"],
+        ])
+
+    def test_mixed_types(self):
+        nested = Tree.from_paths([["n"]])
+        self.assertSameTree([[1, "a"], ["1", "b"], [2.5], [b"x"], [1.0, "c"],
+                             [Tree.Variable("v"), 2], ["1", 1], [True],
+                             [None, "d"], ["a", nested], [nested, "e"]])
+
+    def test_random(self):
+        rng = random.Random(1018)
+        nested = Tree.from_paths([["n"]]).freeze()
+        values = ["a", "b", 1, 1.0, 2, 2.5, b"x", None, nested,
+                  Tree.Variable("x"), Tree.Variable("y", "v"),
+                  Tree.Variable(1)]
+        for _ in range(500):
+            paths = [[rng.choice(values) for _ in range(rng.randint(1, 4))]
+                     for _ in range(rng.randint(0, 8))]
+            with self.subTest(paths=paths):
+                self.assertSameTree(paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
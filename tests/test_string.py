@@ -0,0 +1,40 @@
+"""
+String variables, shared with the caller and cached while versioned
+"""
+
+import pickle
+import unittest
+
+from patlang import String
+
+
+class TestStringVariables(unittest.TestCase):
+
+    def test_plain_dict_is_shared(self):
+        variables = {"name": "world"}
+        pattern = String("hello name")
+        pattern.variables = variables
+        self.assertIs(pattern.variables, variables)
+        self.assertEqual(str(pattern), "hello world")
+        variables["name"] = "there"
+        self.assertEqual(str(pattern), "hello there")
+        pattern["name"] = "you"
+        self.assertEqual(variables["name"], "you")
+        self.assertEqual(str(pattern), "hello you")
+
+    def test_cached_render_follows_changes(self):
+        pattern = String("hello name")
+        pattern["name"] = "world"
+        self.assertEqual(str(pattern), "hello world")
+        pattern.variables["name"] = "there"
+        self.assertEqual(str(pattern), "hello there")
+
+    def test_pickle(self):
+        pattern = String("hello name")
+        pattern.variables = {"name": "world"}
+        self.assertEqual(str(pickle.loads(pickle.dumps(pattern))),
+                         "hello world")
+
+
+if __name__ == "__main__":
+    unittest.main()
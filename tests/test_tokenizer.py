@@ -0,0 +1,140 @@
+"""
+String.toList against the reference behaviour: splitting on every key one
+after the other (the per-key split loop toList used before the tokenizer)
+"""
+
+import random
+import unittest
+
+from patlang import List, String
+
+
+def referenceToList(S, sep="", endline=""):
+    """
+    the per-key split loop of String.toList before the tokenizer
+    """
+    L = [List(str.__str__(S))]
+
+    dictovaries = dict(S.variables)
+
+    if sep != "": dictovaries.update({sep:""});
+    if endline != "": dictovaries.update({endline:""});
+
+    for key in dictovaries:
+        Lint = [List()]
+        for l in L:
+            for item in l:
+                if not isinstance(item, List.Variable):
+                    if key in item:
+                        items = item.split(key)
+                        for idx, item in enumerate(items):
+                            if idx > 0:
+                                if key in S.variables:
+                                    Lint[-1].append(List.Variable(key, S.variables[key]))
+                                    nk = S.variables[key]
+                                    while nk in S.variables:
+                                        Lint[-1].setVariable(key, List.Variable(nk, S.variables[nk]))
+                                        nk = S.variables[nk]
+                                elif key == endline:
+                                    Lint.append(List())
+                            if item != '':
+                                Lint[-1].append(item)
+                    else:
+                        Lint[-1].append(item)
+                else:
+                    Lint[-1].append(item)
+
+        if len(Lint) > 1:
+            L = []
+            for l in Lint:
+                L.append(l.copy())
+        else:
+            L = [Lint[-1].copy()]
+
+    if len(L) > 1:
+        return L
+    else:
+        return L[0]
+
+
+def pattern(text, **variables):
+    S = String(text)
+    for key, value in variables.items():
+        S[key] = value
+    return S
+
+
+def cyclic(variables):
+    """
+    True if chaining values that are keys would never end
+    """
+    for key in variables:
+        seen = {key}
+        while variables[key] in variables:
+            key = variables[key]
+            if key in seen:
+                return True
+            seen.add(key)
+    return False
+
+
+class TestToList(unittest.TestCase):
+
+    def assertSameList(self, S, sep="", endline=""):
+        expected = referenceToList(S, sep, endline)
+        result = S.toList(sep=sep, endline=endline)
+        self.assertEqual(type(result), type(expected))
+        self.assertEqual(repr(result), repr(expected))
+
+    def test_plain(self):
+        self.assertSameList(pattern("hello world"))
+        self.assertSameList(pattern(""))
+        self.assertSameList(pattern("hello NAME", NAME="world"))
+
+    def test_overlapping_keys(self):
+        # an earlier key wins where keys overlap
+        self.assertSameList(pattern("abcabc", ab="x", bc="y"))
+        self.assertSameList(pattern("abcabc", bc="y", ab="x"))
+        self.assertSameList(pattern("aaaa", aa="x", a="y"))
+        self.assertSameList(pattern("ababa", aba="x", b="y"))
+
+    def test_chained_keys(self):
+        # values that are keys themselves become nested variables
+        self.assertSameList(pattern("A and B", A="B", B="C"))
+        self.assertSameList(pattern("B and A", A="B", B="D"))
+        self.assertSameList(pattern("X", X="Y", Y="Z", Z="end"))
+
+    def test_sep(self):
+        self.assertSameList(pattern("a b  c", a="x"), sep=" ")
+        self.assertSameList(pattern("NAME,NAME", NAME="n"), sep=",")
+        self.assertSameList(pattern("a,,b,", a="b"), sep=",")
+
+    def test_endline(self):
+        self.assertSameList(pattern("a\nb\n", a="x"), endline="\n")
+        self.assertSameList(pattern("\nNAME\n\n", NAME="n"), endline="\n")
+        self.assertSameList(pattern("a b\nc d", b="B"), sep=" ",
+                            endline="\n")
+
+    def test_random(self):
+        rng = random.Random(4)
+        chars = "ab,\n"
+        for _ in range(2000):
+            text = "".join(rng.choice(chars)
+                           for _ in range(rng.randint(0, 12)))
+            S = String(text)
+            for _ in range(rng.randint(0, 3)):
+                key = "".join(rng.choice("ab")
+                              for _ in range(rng.randint(1, 3)))
+                S[key] = "".join(rng.choice("abc")
+                                 for _ in range(rng.randint(0, 2)))
+            sep, endline = rng.choice([("", ""), (",", ""), ("", "\n"),
+                                       (",", "\n")])
+            if cyclic(S.variables):
+                continue
+            with self.subTest(text=text, variables=dict(S.variables),
+                              sep=sep, endline=endline):
+                self.assertSameList(S, sep, endline)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Tree behaviour kept from before nodes used __slots__ and Trees were forked
+"""
+
+import gc
+import unittest
+import weakref
+
+from patlang import Tree
+
+
+class TestTree(unittest.TestCase):
+
+    def test_weakref(self):
+        tree = Tree("a", "b")
+        ref = weakref.ref(tree)
+        self.assertIs(ref(), tree)
+        del tree
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def build(self):
+        tree = Tree()
+        tree["x"]["a"]["p"]
+        tree["x"]["b"]["q"]
+        tree["y"]["z"]
+        nested = Tree()
+        nested["b"]["b"]
+        tree["w"][nested.freeze()]
+        tree["w"][Tree()["c"]["c"]]
+        # duplicate siblings, a below x and b in the nested Tree
+        tree.setItem("b", "a")
+        return tree
+
+    def test_remove_forked(self):
+        for value in ("z", "p", "a", "c", "missing"):
+            plain = self.build()
+            base = self.build().freeze()
+            fork = base.copy()
+            self.assertEqual(plain, fork)
+            plain.remove(value)
+            fork.remove(value)
+            self.assertEqual(plain, fork, value)
+            self.assertEqual(repr(plain), repr(fork))
+            self.assertEqual(base, self.build().freeze())
+
+
+if __name__ == "__main__":
+    unittest.main()